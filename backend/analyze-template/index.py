@@ -1,10 +1,338 @@
 import json
 import os
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from html.parser import HTMLParser
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Tuple, Optional
+import psycopg2
+import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
 from openai import OpenAI
 import httpx
 
+CLASSIFICATION_MODEL = 'gpt-4o-mini'
+CLASSIFY_WINDOW_TOKENS = int(os.environ.get('CLASSIFY_WINDOW_TOKENS', '2000'))
+CLASSIFY_WINDOW_BLOCKS = int(os.environ.get('CLASSIFY_WINDOW_BLOCKS', '40'))
+CLASSIFY_CONCURRENCY = int(os.environ.get('CLASSIFY_CONCURRENCY', '4'))
+CLASSIFY_RETRIES = int(os.environ.get('CLASSIFY_RETRIES', '2'))
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[OpenAI] = None
+
+def get_openai_client() -> OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    if _openai_client is None:
+        proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+        http_client = httpx.Client(
+            proxy=proxy_url or None,
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+        )
+        _openai_client = OpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            http_client=http_client,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+    return _openai_client
+
+UNSUBSCRIBE_MARKERS = ('отписаться', 'отписка', 'unsubscribe')
+HIDDEN_STYLE_RE = re.compile(
+    r'display\s*:\s*none|visibility\s*:\s*hidden|mso-hide\s*:\s*all|max-height\s*:\s*0|opacity\s*:\s*0(?![.\d])'
+)
+
+def rule_classify(index: int, block: Dict[str, Any]) -> Optional[Tuple[str, str, float]]:
+    '''Deterministic labels for blocks whose type is obvious from tag, attrs and text'''
+    text = block['text'].lower()
+    tag = block['tag']
+    attrs = block.get('attrs', {})
+    
+    if any(marker in text for marker in UNSUBSCRIBE_MARKERS):
+        return 'footer', 'unsubscribe_text', 0.95
+    if tag == 'a' and (attrs.get('href') or '').strip().lower().startswith('http'):
+        return 'cta', 'cta_text', 0.9
+    if tag == 'h1':
+        return 'headline', 'headline', 0.9
+    if index == 0 and tag in ('div', 'span') and HIDDEN_STYLE_RE.search((attrs.get('style') or '').lower()):
+        return 'preheader', 'preheader', 0.95
+    return None
+
+def pre_classify(blocks: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
+    labels = {}
+    for i, block in enumerate(blocks):
+        rule = rule_classify(i, block)
+        if rule is None:
+            continue
+        block_type, variable_name, confidence = rule
+        labels[i] = {'block_type': block_type, 'variable_name': variable_name, 'confidence': confidence}
+    return labels
+
+def make_names_unique(blocks: List[Dict[str, Any]]) -> None:
+    '''Suffix repeated variable names in document order (cta_text, cta_text_2, ...) whichever source labelled them'''
+    used = set()
+    name_counts: Dict[str, int] = {}
+    for block in blocks:
+        variable_name = block.get('variable_name')
+        if variable_name is None:
+            continue
+        if variable_name in used:
+            count = name_counts.get(variable_name, 1) + 1
+            while f'{variable_name}_{count}' in used:
+                count += 1
+            name_counts[variable_name] = count
+            block['variable_name'] = f'{variable_name}_{count}'
+        used.add(block['variable_name'])
+
+CLASSIFICATION_LRU_SIZE = 4096
+_classification_lru: OrderedDict = OrderedDict()
+
+def block_hash(block: Dict[str, Any]) -> str:
+    normalized = ' '.join(block['text'].lower().split())
+    return hashlib.sha256(f"{block['tag']}\n{normalized}".encode()).hexdigest()
+
+def remember_classification(model: str, digest: str, label: Dict[str, Any]) -> None:
+    _classification_lru[(model, digest)] = label
+    _classification_lru.move_to_end((model, digest))
+    if len(_classification_lru) > CLASSIFICATION_LRU_SIZE:
+        _classification_lru.popitem(last=False)
+
+def get_cached_classifications(cur, model: str, digests: List[str]) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, int]]:
+    '''Resolve block labels through in-process LRU, then block_classification_cache table'''
+    stats = {'memory_hits': 0, 'db_hits': 0}
+    labels: Dict[str, Dict[str, Any]] = {}
+    unresolved = []
+    
+    for digest in dict.fromkeys(digests):
+        cached = _classification_lru.get((model, digest))
+        if cached is not None:
+            _classification_lru.move_to_end((model, digest))
+            labels[digest] = cached
+            stats['memory_hits'] += 1
+        else:
+            unresolved.append(digest)
+    
+    if unresolved:
+        cur.execute(
+            """SELECT block_hash, block_type, variable_name, confidence FROM block_classification_cache
+            WHERE model = %s AND block_hash = ANY(%s)""",
+            (model, unresolved)
+        )
+        for digest, block_type, variable_name, confidence in cur.fetchall():
+            label = {'block_type': block_type, 'variable_name': variable_name, 'confidence': confidence}
+            remember_classification(model, digest, label)
+            labels[digest] = label
+            stats['db_hits'] += 1
+    
+    return labels, stats
+
+BLOCK_TYPES = (
+    'preheader', 'headline', 'subheadline', 'body', 'cta', 'agenda', 'speaker',
+    'benefits', 'social_proof', 'deadline', 'footer', 'other'
+)
+VARIABLE_NAME_MAX = 100
+
+def clean_label(classification: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''Fit an LLM answer to block_classification_cache columns; None when it has no usable variable name'''
+    block_type = str(classification.get('block_type') or '').strip().lower()
+    if block_type not in BLOCK_TYPES:
+        block_type = 'other'
+    variable_name = re.sub(r'[^a-z0-9_]+', '_', str(classification.get('variable_name') or '').lower()).strip('_')
+    if not variable_name:
+        return None
+    try:
+        confidence = float(classification.get('confidence'))
+    except (TypeError, ValueError):
+        confidence = None
+    return {
+        'block_type': block_type,
+        'variable_name': variable_name[:VARIABLE_NAME_MAX].rstrip('_'),
+        'confidence': confidence
+    }
+
+def store_classifications(cur, model: str, labels: Dict[str, Dict[str, Any]]) -> None:
+    if not labels:
+        return
+    for digest, label in labels.items():
+        remember_classification(model, digest, label)
+    psycopg2.extras.execute_values(
+        cur,
+        """INSERT INTO block_classification_cache
+        (model, block_hash, block_type, variable_name, confidence) VALUES %s
+        ON CONFLICT DO NOTHING""",
+        [
+            (model, digest, label['block_type'], label['variable_name'], label.get('confidence'))
+            for digest, label in labels.items()
+        ]
+    )
+
+def classify_blocks(client: OpenAI, indexed_blocks: List[Tuple[int, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    '''Ask the LLM to label the given blocks; block_index in the answer is the global 1-based index'''
+    blocks_text = '\n'.join([
+        f"{i+1}. Tag: {b['tag']}, Text: {b['text'][:100]}..." 
+        for i, b in indexed_blocks
+    ])
+    
+    prompt = f"""Analyze these HTML email blocks and classify each one.
+
+Blocks:
+{blocks_text}
+
+For each block, return JSON array with:
+- block_index (number, as listed above)
+- block_type (one of: preheader, headline, subheadline, body, cta, agenda, speaker, benefits, social_proof, deadline, footer, other)
+- variable_name (suggested variable name in snake_case)
+- confidence (0.0 to 1.0)
+
+Block types:
+- preheader: preview text (50-100 chars)
+- headline: main heading (h1, h2, large text)
+- subheadline: secondary heading
+- body: descriptive paragraph text
+- cta: call-to-action button/link
+- agenda: event schedule/program
+- speaker: speaker information
+- benefits: list of advantages
+- social_proof: testimonials, cases, results
+- deadline: deadline/urgency info
+- footer: email footer, contacts, unsubscribe
+- other: everything else
+
+Return ONLY valid JSON array, no markdown formatting."""
+
+    response = client.chat.completions.create(
+        model=CLASSIFICATION_MODEL,
+        messages=[
+            {'role': 'system', 'content': 'You are an expert at analyzing email HTML structure. Return only valid JSON.'},
+            {'role': 'user', 'content': prompt}
+        ],
+        temperature=0.3
+    )
+    
+    ai_response = response.choices[0].message.content.strip()
+    
+    if ai_response.startswith('```json'):
+        ai_response = ai_response[7:]
+    if ai_response.startswith('```'):
+        ai_response = ai_response[3:]
+    if ai_response.endswith('```'):
+        ai_response = ai_response[:-3]
+    
+    classifications = json.loads(ai_response.strip())
+    if isinstance(classifications, dict):
+        classifications = next((v for v in classifications.values() if isinstance(v, list)), [])
+    return classifications
+
+# Shared across warm invocations, windows of one template are classified concurrently
+_classify_executor = ThreadPoolExecutor(max_workers=CLASSIFY_CONCURRENCY)
+
+def estimate_tokens(text: str) -> int:
+    # Cyrillic averages about 2 characters per token, keep the estimate conservative
+    return len(text) // 2 + 1
+
+def make_windows(indexed_blocks: List[Tuple[int, Dict[str, Any]]]) -> List[List[Tuple[int, Dict[str, Any]]]]:
+    '''Split blocks into prompt windows bounded by estimated tokens and block count (bounds the JSON answer too)'''
+    windows = []
+    current: List[Tuple[int, Dict[str, Any]]] = []
+    current_tokens = 0
+    for i, block in indexed_blocks:
+        tokens = estimate_tokens(block['text'][:100]) + 10
+        if current and (current_tokens + tokens > CLASSIFY_WINDOW_TOKENS or len(current) >= CLASSIFY_WINDOW_BLOCKS):
+            windows.append(current)
+            current, current_tokens = [], 0
+        current.append((i, block))
+        current_tokens += tokens
+    if current:
+        windows.append(current)
+    return windows
+
+def classify_window(client: OpenAI, window: List[Tuple[int, Dict[str, Any]]]) -> Tuple[List[Dict[str, Any]], int, Optional[str]]:
+    '''Classify one window, retrying only this window on truncated/invalid answers'''
+    expected = {i + 1 for i, _ in window}
+    error = None
+    for attempt in range(CLASSIFY_RETRIES + 1):
+        try:
+            classifications = classify_blocks(client, window)
+            return [c for c in classifications if c.get('block_index') in expected], attempt, None
+        except Exception as e:
+            error = str(e)
+    return [], CLASSIFY_RETRIES, error
+
+def classify_in_windows(client: OpenAI, indexed_blocks: List[Tuple[int, Dict[str, Any]]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    windows = make_windows(indexed_blocks)
+    futures = [_classify_executor.submit(classify_window, client, window) for window in windows]
+    
+    classifications = []
+    stats = {'windows': len(windows), 'retries': 0, 'failed_windows': [], 'failed_blocks': 0}
+    for window, future in zip(windows, futures):
+        window_classifications, retries, error = future.result()
+        classifications.extend(window_classifications)
+        stats['retries'] += retries
+        if error:
+            stats['failed_windows'].append({
+                'first_block': window[0][0] + 1,
+                'last_block': window[-1][0] + 1,
+                'error': error
+            })
+            stats['failed_blocks'] += len(window)
+    return classifications, stats
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Analyze HTML email template and extract semantic blocks with AI classification
@@ -69,70 +397,56 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
     
-    openai_api_key = os.environ.get('OPENAI_API_KEY', '')
-    proxy_url = os.environ.get('OPENAI_PROXY_URL')
+    local_labels = pre_classify(blocks)
+    digests = [block_hash(block) for block in blocks]
+    ambiguous = [i for i in range(len(blocks)) if i not in local_labels]
     
-    http_client = httpx.Client(proxies=proxy_url) if proxy_url else None
-    client = OpenAI(api_key=openai_api_key, http_client=http_client)
+    cached_labels: Dict[str, Dict[str, Any]] = {}
+    cache_stats = {'memory_hits': 0, 'db_hits': 0}
+    if ambiguous:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cached_labels, cache_stats = get_cached_classifications(
+                    cur, CLASSIFICATION_MODEL, [digests[i] for i in ambiguous]
+                )
+        finally:
+            release_db_connection(conn)
     
-    blocks_text = '\n'.join([
-        f"{i+1}. Tag: {b['tag']}, Text: {b['text'][:100]}..." 
-        for i, b in enumerate(blocks)
-    ])
-    
-    prompt = f"""Analyze these HTML email blocks and classify each one.
-
-Blocks:
-{blocks_text}
-
-For each block, return JSON array with:
-- block_index (number, 1-based)
-- block_type (one of: preheader, headline, subheadline, body, cta, agenda, speaker, benefits, social_proof, deadline, footer, other)
-- variable_name (suggested variable name in snake_case)
-- confidence (0.0 to 1.0)
-
-Block types:
-- preheader: preview text (50-100 chars)
-- headline: main heading (h1, h2, large text)
-- subheadline: secondary heading
-- body: descriptive paragraph text
-- cta: call-to-action button/link
-- agenda: event schedule/program
-- speaker: speaker information
-- benefits: list of advantages
-- social_proof: testimonials, cases, results
-- deadline: deadline/urgency info
-- footer: email footer, contacts, unsubscribe
-- other: everything else
-
-Return ONLY valid JSON array, no markdown formatting."""
-
-    response = client.chat.completions.create(
-        model='gpt-4o-mini',
-        messages=[
-            {'role': 'system', 'content': 'You are an expert at analyzing email HTML structure. Return only valid JSON.'},
-            {'role': 'user', 'content': prompt}
-        ],
-        temperature=0.3
-    )
+    # Only ambiguous blocks never seen before (by tag + normalized text) go to the LLM
+    unseen = [(i, blocks[i]) for i in ambiguous if digests[i] not in cached_labels]
+    classifications, window_stats = classify_in_windows(get_openai_client(), unseen) if unseen else ([], None)
     
-    ai_response = response.choices[0].message.content.strip()
+    unseen_indexes = {i for i, _ in unseen}
+    new_labels = {}
+    for classification in classifications:
+        idx = classification['block_index'] - 1
+        label = clean_label(classification) if idx in unseen_indexes else None
+        if label:
+            new_labels[digests[idx]] = label
     
-    if ai_response.startswith('```json'):
-        ai_response = ai_response[7:]
-    if ai_response.startswith('```'):
-        ai_response = ai_response[3:]
-    if ai_response.endswith('```'):
-        ai_response = ai_response[:-3]
+    if new_labels:
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                store_classifications(cur, CLASSIFICATION_MODEL, new_labels)
+            conn.commit()
+        finally:
+            release_db_connection(conn)
     
-    classifications = json.loads(ai_response.strip())
+    cache_stats['misses'] = len(unseen)
+    labels = {**cached_labels, **new_labels}
+    for idx, block in enumerate(blocks):
+        label = local_labels.get(idx) or labels.get(digests[idx])
+        if label:
+            block.update(label)
+    make_names_unique(blocks)
     
-    for classification in classifications:
-        idx = classification['block_index'] - 1
-        if 0 <= idx < len(blocks):
-            blocks[idx]['block_type'] = classification['block_type']
-            blocks[idx]['variable_name'] = classification['variable_name']
-            blocks[idx]['confidence'] = classification['confidence']
+    resolution = {
+        'local': len(local_labels),
+        'cached': len(ambiguous) - len(unseen),
+        'remote': len(unseen)
+    }
     
     variables = []
     for block in blocks:
@@ -144,11 +458,7 @@ Return ONLY valid JSON array, no markdown formatting."""
                 'confidence': block.get('confidence', 0.0)
             })
     
-    template_html = html_content
-    for block in blocks:
-        if 'variable_name' in block and block['text']:
-            placeholder = '{{' + block['variable_name'] + '}}'
-            template_html = template_html.replace(block['text'], placeholder, 1)
+    template_html = splice_placeholders(html_content, blocks)
     
     return {
         'statusCode': 200,
@@ -161,21 +471,48 @@ Return ONLY valid JSON array, no markdown formatting."""
             'template_html': template_html,
             'blocks': blocks,
             'variables': variables,
-            'blocks_count': len(blocks)
+            'blocks_count': len(blocks),
+            'classification_cache': cache_stats,
+            'classification_resolution': resolution,
+            'classification_windows': window_stats
         }, ensure_ascii=False)
     }
 
 
 class EmailHTMLParser(HTMLParser):
+    '''Collects text blocks with their exact [start, end) offsets in the source fed to it'''
     def __init__(self):
         super().__init__()
         self.blocks: List[Dict[str, Any]] = []
         self.current_tag: str = ''
         self.current_text: str = ''
         self.current_attrs: Dict[str, str] = {}
+        self.current_span: Optional[List[int]] = None
         self.ignore_tags = {'script', 'style', 'head', 'meta', 'link'}
+        self.source: str = ''
+        self.line_starts: List[int] = [0]
+    
+    def feed(self, data: str):
+        # Offsets are computed against a single document, feed it in one call
+        self.source = data
+        self.line_starts = [0] + [match.end() for match in re.finditer('\n', data)]
+        super().feed(data)
+    
+    def source_offset(self) -> int:
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+    
+    def mark_boundary(self):
+        # Text data runs until the next markup event; close the open span at that point
+        if self.current_span is not None and self.current_span[1] is None:
+            start, end = self.current_span[0], self.source_offset()
+            raw = self.source[start:end]
+            start += len(raw) - len(raw.lstrip())
+            end -= len(raw) - len(raw.rstrip())
+            self.current_span = [start, max(start, end)]
     
     def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]):
+        self.mark_boundary()
         if tag not in self.ignore_tags:
             self.current_tag = tag
             self.current_attrs = dict(attrs)
@@ -184,17 +521,49 @@ class EmailHTMLParser(HTMLParser):
         text = data.strip()
         if text and self.current_tag and self.current_tag not in self.ignore_tags:
             self.current_text = text
+            self.current_span = [self.source_offset(), None]
     
     def handle_endtag(self, tag: str):
+        self.mark_boundary()
         if tag not in self.ignore_tags and self.current_text:
             self.blocks.append({
                 'text': self.current_text,
                 'tag': self.current_tag,
                 'length': len(self.current_text),
-                'attrs': self.current_attrs.copy()
+                'attrs': self.current_attrs.copy(),
+                'source_start': self.current_span[0],
+                'source_end': self.current_span[1]
             })
             self.current_text = ''
             self.current_attrs = {}
+            self.current_span = None
+    
+    def handle_comment(self, data: str):
+        self.mark_boundary()
+    
+    def handle_decl(self, decl: str):
+        self.mark_boundary()
+    
+    def handle_pi(self, data: str):
+        self.mark_boundary()
     
     def get_blocks(self) -> List[Dict[str, Any]]:
         return self.blocks
+
+def splice_placeholders(html: str, blocks: List[Dict[str, Any]]) -> str:
+    '''One left-to-right rebuild: each classified block is replaced at its own recorded position'''
+    parts = []
+    pos = 0
+    targets = sorted(
+        (block for block in blocks if 'variable_name' in block and block['text']),
+        key=lambda block: block['source_start']
+    )
+    for block in targets:
+        start, end = block['source_start'], block['source_end']
+        if start < pos:
+            continue
+        parts.append(html[pos:start])
+        parts.append('{{' + block['variable_name'] + '}}')
+        pos = end
+    parts.append(html[pos:])
+    return ''.join(parts)
@@ -6,12 +6,191 @@ Returns: HTTP response dict с записями базы знаний
 '''
 import json
 import os
-from typing import Dict, Any
+import base64
+import hashlib
+import time
+from typing import Dict, Any, List, Optional
 import psycopg2
+from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+LIST_HEAVY_COLUMNS = ('content',)
+
+_table_columns: Dict[str, List[str]] = {}
+
+def table_columns(cur, table: str) -> List[str]:
+    if table not in _table_columns:
+        cur.execute(sql.SQL("SELECT * FROM {} LIMIT 0").format(sql.Identifier(table)))
+        _table_columns[table] = [column[0] for column in cur.description]
+    return _table_columns[table]
+
+def encode_cursor(row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'id': row_id}).encode()).decode()
+
+def decode_cursor(cursor: str) -> int:
+    return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['id'])
+
+def list_page(cur, table: str, params: Dict[str, Any], heavy_columns: tuple, filters: Dict[str, Any]) -> Dict[str, Any]:
+    '''Keyset page ordered by id DESC: light columns unless fields= asks otherwise, total only on request'''
+    columns = table_columns(cur, table)
+    requested = (params.get('fields') or '').strip()
+    if requested == '*':
+        selected = list(columns)
+    elif requested:
+        selected = [name for name in dict.fromkeys(field.strip() for field in requested.split(',')) if name in columns]
+    else:
+        selected = [name for name in columns if name not in heavy_columns]
+    if 'id' not in selected:
+        selected.insert(0, 'id')
+    
+    limit = min(max(int(params.get('limit') or LIST_DEFAULT_LIMIT), 1), LIST_MAX_LIMIT)
+    
+    conditions = [sql.SQL("{} = %s").format(sql.Identifier(name)) for name in filters]
+    values: List[Any] = list(filters.values())
+    where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+    
+    page_conditions = list(conditions)
+    page_values = list(values)
+    if params.get('cursor'):
+        page_conditions.append(sql.SQL("id < %s"))
+        page_values.append(decode_cursor(params['cursor']))
+    page_where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(page_conditions) if page_conditions else sql.SQL("")
+    
+    cur.execute(
+        sql.SQL("SELECT {fields} FROM {table}{where} ORDER BY id DESC LIMIT %s").format(
+            fields=sql.SQL(', ').join(sql.Identifier(name) for name in selected),
+            table=sql.Identifier(table),
+            where=page_where
+        ),
+        page_values + [limit + 1]
+    )
+    rows = cur.fetchall()
+    
+    page = {
+        'items': [dict(row) for row in rows[:limit]],
+        'next_cursor': encode_cursor(rows[limit - 1]['id']) if len(rows) > limit else None
+    }
+    
+    if params.get('include_total') in ('1', 'true'):
+        cur.execute(
+            sql.SQL("SELECT COUNT(*) AS total FROM {table}{where}").format(table=sql.Identifier(table), where=where),
+            values
+        )
+        page['total'] = cur.fetchone()['total']
+    
+    return page
+
+CACHE_CONTROL = 'private, no-cache'
+
+def request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value or ''
+    return ''
+
+def table_version(cur, table: str, filters: Dict[str, Any]) -> List[Any]:
+    '''Row count, newest id and newest row version under the same filters as the list.
+    xmin moves on every insert and update, so in-place edits change the version without reading any column values'''
+    conditions = [sql.SQL("{} = %s").format(sql.Identifier(name)) for name in filters]
+    where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+    cur.execute(
+        sql.SQL(
+            "SELECT COUNT(*) AS rows, MAX(id) AS last_id, MAX(xmin::text::bigint) AS last_xmin FROM {table}{where}"
+        ).format(table=sql.Identifier(table), where=where),
+        list(filters.values())
+    )
+    row = cur.fetchone()
+    return [row['rows'], row['last_id'], row['last_xmin']]
+
+def make_etag(*parts: Any) -> str:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return f'W/"{digest[:16]}"'
+
+def etag_matches(event: Dict[str, Any], etag: str, exists: bool = True) -> bool:
+    '''Weak comparison against every tag listed in If-None-Match; * only matches a resource that exists'''
+    header = request_header(event, 'If-None-Match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return exists
+    opaque = etag[2:]
+    return any(tag.strip().removeprefix('W/') == opaque for tag in header.split(','))
+
+def not_modified(etag: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {
+            'ETag': etag,
+            'Cache-Control': CACHE_CONTROL,
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'ETag'
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def cached_headers(etag: str) -> Dict[str, str]:
+    return {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'ETag': etag,
+        'Cache-Control': CACHE_CONTROL,
+        'Access-Control-Expose-Headers': 'ETag'
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
@@ -22,7 +201,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -37,17 +216,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             params = event.get('queryStringParameters', {}) or {}
             event_id = params.get('event_id')
             
-            if event_id:
-                cur.execute("SELECT * FROM knowledge_base WHERE event_id = %s ORDER BY created_at DESC", (event_id,))
-            else:
-                cur.execute("SELECT * FROM knowledge_base ORDER BY created_at DESC")
+            filters = {'event_id': event_id} if event_id else {}
+            etag = make_etag('knowledge_base', params, table_version(cur, 'knowledge_base', filters))
+            if etag_matches(event, etag):
+                return not_modified(etag)
             
-            results = cur.fetchall()
+            try:
+                page = list_page(cur, 'knowledge_base', params, LIST_HEAVY_COLUMNS, filters)
+            except (ValueError, KeyError, TypeError):
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid limit or cursor'}),
+                    'isBase64Encoded': False
+                }
             
             return {
                 'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps([dict(row) for row in results], default=str),
+                'headers': cached_headers(etag),
+                'body': json.dumps(page, default=str),
                 'isBase64Encoded': False
             }
         
@@ -132,4 +319,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
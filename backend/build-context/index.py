@@ -1,21 +1,69 @@
 '''
 Business: Build complete context for email rendering from Knowledge Base
-Args: event with httpMethod, body containing event_id, template_type, overrides
+Args: event with httpMethod, body containing event_id, template_type, overrides, fields (optional column projection per section)
 Returns: HTTP response with merged context (brand + defaults + event + content + speakers + program)
 '''
 
+import hashlib
 import json
 import os
+import time
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any, Optional
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Dict, Any, List, Optional
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    if not dsn:
-        raise ValueError('DATABASE_URL not set')
-    return psycopg2.connect(dsn)
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
 
 def add_utm_to_url(url: str, utm_params: Dict[str, str], utm_content: str = '') -> str:
     if not url or url == '#':
@@ -34,59 +82,192 @@ def add_utm_to_url(url: str, utm_params: Dict[str, str], utm_content: str = '')
     new_query = urlencode(query_params, doseq=True)
     return urlunparse((parsed.scheme, parsed.netloc, parsed.path, parsed.params, new_query, parsed.fragment))
 
-def build_context(conn, event_id: str, template_type: str, overrides: Optional[Dict] = None) -> Dict[str, Any]:
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+GLOBAL_CONFIG_TTL = 300
+
+GLOBAL_SECTIONS = [
+    ('brand', 'kb_brand', False),
+    ('defaults', 'kb_defaults', False),
+]
+
+CONTEXT_SECTIONS = [
+    ('event', 'kb_events', False),
+    ('content', 'kb_content', False),
+    ('speakers', 'kb_speakers', True),
+    ('program', 'kb_program', False),
+    ('sections', 'kb_sections', True),
+    ('talks', 'kb_talks', True),
+    ('tickets', 'kb_tickets', False),
+    ('assets', 'kb_assets', False),
+    ('campaign', 'kb_campaigns', False),
+]
+
+# Columns build_context itself reads, always fetched when a projection is requested
+META_COLUMNS = {
+    'event': ['event_id', 'name', 'landing', 'site'],
+    'content': ['cta_texts', 'subjects', 'preheaders'],
+    'campaign': ['subject_a', 'subject_b', 'preheader'],
+}
+
+CACHE_CONTROL = 'private, no-cache'
+
+_section_columns: Dict[str, List[str]] = {}
+
+def section_columns(conn, table: str) -> List[str]:
+    if table not in _section_columns:
+        cur = conn.cursor()
+        cur.execute(sql.SQL('SELECT * FROM {} LIMIT 0').format(sql.Identifier(table)))
+        _section_columns[table] = [column[0] for column in cur.description]
+        cur.close()
+    return _section_columns[table]
+
+def fields_error(conn, fields: Any) -> Optional[str]:
+    '''Why a requested projection cannot be used, None when every section and column is known'''
+    if fields is None:
+        return None
+    if not isinstance(fields, dict):
+        return 'fields must be an object mapping section names to column lists'
+    tables = {name: table for name, table, _ in GLOBAL_SECTIONS + CONTEXT_SECTIONS}
+    for section, columns in fields.items():
+        if section not in tables:
+            return f'Unknown section in fields: {section}'
+        if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns):
+            return f'fields.{section} must be a list of column names'
+        known = section_columns(conn, tables[section])
+        unknown = [column for column in columns if column not in known]
+        if unknown:
+            return f'Unknown columns in fields.{section}: {", ".join(unknown)}'
+    return None
+
+def section_where(name: str) -> sql.Composable:
+    if name in ('brand', 'defaults'):
+        return sql.SQL('')
+    if name == 'campaign':
+        return sql.SQL(' WHERE event_id = %(event_id)s AND campaign_type = %(template_type)s')
+    return sql.SQL(' WHERE event_id = %(event_id)s')
+
+def section_query(name: str, table: str, many: bool, columns: Optional[List[str]]) -> sql.Composable:
+    if columns:
+        wanted = list(dict.fromkeys(META_COLUMNS.get(name, []) + list(columns)))
+        select = sql.SQL(', ').join(sql.Identifier(column) for column in wanted)
+    else:
+        select = sql.SQL('*')
+    
+    inner = sql.SQL('SELECT {} FROM {}{}').format(select, sql.Identifier(table), section_where(name))
+    if many:
+        return sql.SQL("(SELECT COALESCE(json_agg(r), '[]'::json) FROM ({}) r)").format(inner)
+    return sql.SQL('(SELECT row_to_json(r) FROM ({} LIMIT 1) r)').format(inner)
+
+# kb_brand/kb_defaults rows survive warm invocations; checked against MAX(updated_at) on every request
+_global_config: Dict[str, Any] = {}
+
+CONFIG_VERSION_QUERY = sql.SQL(
+    '(SELECT json_build_array((SELECT MAX(updated_at) FROM kb_brand), (SELECT MAX(updated_at) FROM kb_defaults)))'
+)
+
+def parse_json_field(value: Any, default: Any) -> Any:
+    if isinstance(value, str):
+        return json.loads(value)
+    return value if value is not None else default
+
+def store_global_config(brand: Dict[str, Any], defaults: Dict[str, Any], version: Any) -> None:
+    _global_config.clear()
+    _global_config.update({
+        'brand': brand,
+        'defaults': defaults,
+        'utm': parse_json_field(defaults.get('utm'), {}),
+        'cta_texts': parse_json_field(defaults.get('cta_texts'), {}),
+        'version': version,
+        'loaded_at': time.monotonic()
+    })
+
+def global_config_fresh() -> bool:
+    return bool(_global_config) and time.monotonic() - _global_config['loaded_at'] < GLOBAL_CONFIG_TTL
+
+def section_version(name: str, table: str) -> sql.Composable:
+    # Row count and newest row version (xmin moves on every insert and update) without reading column values
+    return sql.SQL('(SELECT json_build_array(COUNT(*), MAX(t.xmin::text::bigint)) FROM {} t{})').format(
+        sql.Identifier(table), section_where(name)
+    )
+
+def fetch_document(conn, sections: List[tuple], params: Dict[str, Any], fields: Dict[str, List[str]]) -> Dict[str, Any]:
+    pairs = [sql.Literal('config_version'), CONFIG_VERSION_QUERY]
+    versions = []
+    for name, table, many in sections:
+        pairs.append(sql.Literal(name))
+        pairs.append(section_query(name, table, many, fields.get(name)))
+        if (name, table, many) in CONTEXT_SECTIONS:
+            versions.append(sql.Literal(name))
+            versions.append(section_version(name, table))
+    pairs.append(sql.Literal('versions'))
+    pairs.append(sql.SQL('json_build_object({})').format(sql.SQL(', ').join(versions)))
+    
+    query = sql.SQL('SELECT json_build_object({})').format(sql.SQL(', ').join(pairs))
+    
+    cur = conn.cursor()
+    cur.execute(query, params)
+    document = cur.fetchone()[0]
+    cur.close()
+    return document
+
+def context_etag(body_data: Dict[str, Any], rows: Dict[str, Any]) -> str:
+    '''Request body plus the config version and per-section stamps the document query already returned'''
+    version = [rows['config_version'], rows['versions']]
+    digest = hashlib.sha256(json.dumps([body_data, version], sort_keys=True, default=str).encode()).hexdigest()
+    return f'W/"{digest[:16]}"'
+
+def etag_matches(event: Dict[str, Any], etag: str, exists: bool = True) -> bool:
+    '''Weak comparison against every tag listed in If-None-Match; * only matches a resource that exists'''
+    header = next((value for key, value in (event.get('headers') or {}).items() if key.lower() == 'if-none-match'), '')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return exists
+    opaque = etag[2:]
+    return any(tag.strip().removeprefix('W/') == opaque for tag in header.split(','))
+
+def fetch_context_rows(conn, event_id: str, template_type: str, fields: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+    '''Event-scoped context in one round trip; global rows are read only when the warm cache is cold or stale'''
+    warm = global_config_fresh()
+    sections = CONTEXT_SECTIONS if warm else GLOBAL_SECTIONS + CONTEXT_SECTIONS
+    params = {'event_id': event_id, 'template_type': template_type}
+    # Global rows are cached whole, projection for them is applied in build_context
+    event_fields = {name: columns for name, columns in (fields or {}).items() if name not in ('brand', 'defaults')}
+    rows = fetch_document(conn, sections, params, event_fields)
+    
+    if not warm:
+        store_global_config(rows.get('brand') or {}, rows.get('defaults') or {}, rows['config_version'])
+    elif rows['config_version'] != _global_config['version']:
+        config_rows = fetch_document(conn, GLOBAL_SECTIONS, params, {})
+        store_global_config(config_rows.get('brand') or {}, config_rows.get('defaults') or {}, config_rows['config_version'])
+    
+    return rows
+
+def project_row(row: Dict[str, Any], columns: Optional[List[str]]) -> Dict[str, Any]:
+    if not columns:
+        return row
+    return {column: row[column] for column in columns if column in row}
+
+def build_context(rows: Dict[str, Any], event_id: str, template_type: str, overrides: Optional[Dict] = None,
+                  fields: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
     overrides = overrides or {}
     
-    cur.execute("SELECT * FROM kb_brand LIMIT 1")
-    brand = dict(cur.fetchone() or {})
-    
-    cur.execute("SELECT * FROM kb_defaults LIMIT 1")
-    defaults = dict(cur.fetchone() or {})
-    
-    cur.execute("SELECT * FROM kb_events WHERE event_id = %s", (event_id,))
-    event = dict(cur.fetchone() or {})
-    
+    event = rows.get('event') or {}
     if not event:
         raise ValueError(f'Event {event_id} not found')
     
-    cur.execute("SELECT * FROM kb_content WHERE event_id = %s LIMIT 1", (event_id,))
-    content = dict(cur.fetchone() or {})
-    
-    cur.execute("SELECT * FROM kb_speakers WHERE event_id = %s", (event_id,))
-    speakers_rows = cur.fetchall()
-    speakers = [dict(row) for row in speakers_rows]
-    
-    cur.execute("SELECT * FROM kb_program WHERE event_id = %s LIMIT 1", (event_id,))
-    program_row = cur.fetchone()
-    program = dict(program_row) if program_row else {}
-    
-    cur.execute("SELECT * FROM kb_sections WHERE event_id = %s", (event_id,))
-    sections_rows = cur.fetchall()
-    sections = [dict(row) for row in sections_rows]
-    
-    cur.execute("SELECT * FROM kb_talks WHERE event_id = %s", (event_id,))
-    talks_rows = cur.fetchall()
-    talks = [dict(row) for row in talks_rows]
-    
-    cur.execute("SELECT * FROM kb_tickets WHERE event_id = %s LIMIT 1", (event_id,))
-    tickets_row = cur.fetchone()
-    tickets = dict(tickets_row) if tickets_row else {}
-    
-    cur.execute("SELECT * FROM kb_assets WHERE event_id = %s LIMIT 1", (event_id,))
-    assets_row = cur.fetchone()
-    assets = dict(assets_row) if assets_row else {}
-    
-    cur.execute("SELECT * FROM kb_campaigns WHERE event_id = %s AND campaign_type = %s LIMIT 1", 
-                (event_id, template_type))
-    campaign_row = cur.fetchone()
-    campaign = dict(campaign_row) if campaign_row else {}
+    fields = fields or {}
+    brand = project_row(_global_config['brand'], fields.get('brand'))
+    defaults = project_row(_global_config['defaults'], fields.get('defaults'))
+    content = rows.get('content') or {}
+    speakers = rows.get('speakers') or []
+    program = rows.get('program') or {}
+    sections = rows.get('sections') or []
+    talks = rows.get('talks') or []
+    tickets = rows.get('tickets') or {}
+    assets = rows.get('assets') or {}
+    campaign = rows.get('campaign') or {}
     
-    cur.close()
-    
-    utm_params = defaults.get('utm', {})
-    if isinstance(utm_params, str):
-        utm_params = json.loads(utm_params)
+    utm_params = _global_config['utm']
     
     cta_url = overrides.get('ctaUrl') or event.get('landing') or event.get('site') or '#'
     cta_top_url = add_utm_to_url(cta_url, utm_params, 'cta_top')
@@ -96,9 +277,7 @@ def build_context(conn, event_id: str, template_type: str, overrides: Optional[D
     if isinstance(content_cta_texts, str):
         content_cta_texts = json.loads(content_cta_texts)
     
-    defaults_cta_texts = defaults.get('cta_texts', {})
-    if isinstance(defaults_cta_texts, str):
-        defaults_cta_texts = json.loads(defaults_cta_texts)
+    defaults_cta_texts = _global_config['cta_texts']
     
     template_cta = content_cta_texts.get(template_type, {})
     
@@ -128,7 +307,7 @@ def build_context(conn, event_id: str, template_type: str, overrides: Optional[D
     
     preheader = (overrides.get('preheader') or 
                  campaign.get('preheader') or 
-                 (preheaders[0] if preheaders else defaults.get('preheader', '')))
+                 (preheaders[0] if preheaders else _global_config['defaults'].get('preheader', '')))
     
     context = {
         'brand': brand,
@@ -165,7 +344,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -187,6 +366,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         event_id = body_data.get('event_id')
         template_type = body_data.get('template_type', 'sales_via_pain')
         overrides = body_data.get('overrides', {})
+        fields = body_data.get('fields')
         
         if not event_id:
             return {
@@ -196,11 +376,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        result_context = build_context(conn, event_id, template_type, overrides)
+        error = fields_error(conn, fields)
+        if error:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': error}),
+                'isBase64Encoded': False
+            }
+        
+        rows = fetch_context_rows(conn, event_id, template_type, fields)
+        etag = context_etag(body_data, rows)
+        cache_headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL, 'Access-Control-Expose-Headers': 'ETag'}
+        if etag_matches(event, etag, exists=bool(rows.get('event'))):
+            return {
+                'statusCode': 304,
+                'headers': {'Access-Control-Allow-Origin': '*', **cache_headers},
+                'body': '',
+                'isBase64Encoded': False
+            }
+        
+        result_context = build_context(rows, event_id, template_type, overrides, fields)
         
         return {
             'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **cache_headers},
             'body': json.dumps(result_context, default=str),
             'isBase64Encoded': False
         }
@@ -223,4 +423,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     finally:
-        conn.close()
+        release_db_connection(conn)
@@ -0,0 +1,75 @@
+'''
+Business: Benchmark of validate_html single-pass linter against the previous regex scans
+Args: --sizes-kb template sizes (default 50,75,100), --iterations N (default 20)
+Returns: prints per-call time of both implementations on the same generated template
+'''
+import argparse
+import re
+import time
+
+from index import validate_html
+
+def legacy_validate_html(html: str) -> dict:
+    warnings = []
+    
+    unfilled = re.findall(r'\{\{([^}]+)\}\}', html)
+    if unfilled:
+        warnings.append(f'Незаполненные переменные: {", ".join(unfilled)}')
+    
+    empty_hrefs = re.findall(r'<a[^>]+href="#"[^>]*>(?!.*unsubscribe)', html, re.IGNORECASE)
+    if empty_hrefs:
+        warnings.append(f'Найдено {len(empty_hrefs)} пустых href="#" (не unsubscribe)')
+    
+    if len(html) < 100:
+        warnings.append('HTML слишком короткий (менее 100 символов)')
+    
+    cta_patterns = [r'<a[^>]+href="http', r'<button']
+    has_valid_cta = any(re.search(pattern, html, re.IGNORECASE) for pattern in cta_patterns)
+    if not has_valid_cta:
+        warnings.append('Не найдено валидных CTA (ссылки или кнопки)')
+    
+    return {"is_valid": len(warnings) == 0, "warnings": warnings}
+
+def build_template(size_kb: int, minified: bool) -> str:
+    # Minified markup with an empty href in every row is the worst case for the legacy lookahead;
+    # the indented layout with real links is what generated emails usually look like
+    if minified:
+        row = (
+            '<tr><td class="card"><img src="https://cdn.example.com/s.png" alt="Спикер">'
+            '<p>Доклад о найме и удержании команды</p><a href="#">Подробнее</a></td></tr>'
+        )
+    else:
+        row = (
+            '<tr>\n  <td class="card">\n    <img src="https://cdn.example.com/s.png" alt="Спикер">\n'
+            '    <p>Доклад о найме и удержании команды</p>\n'
+            '    <a href="https://humanconf.ru/talks">Подробнее</a>\n  </td>\n</tr>\n'
+        )
+    rows = row * (size_kb * 1024 // len(row.encode('utf-8')) + 1)
+    return (
+        '<html><body><table>' + rows +
+        '<tr><td><a href="https://humanconf.ru/reg">Зарегистрироваться</a>'
+        '<a href="#unsubscribe">Отписаться</a></td></tr></table></body></html>'
+    )
+
+def per_call_ms(func, html: str, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(html)
+    return (time.perf_counter() - started) / iterations * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes-kb', default='50,75,100')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+    
+    for minified in (True, False):
+        layout = 'minified' if minified else 'indented'
+        for size_kb in [int(size) for size in args.sizes_kb.split(',')]:
+            html = build_template(size_kb, minified)
+            before = per_call_ms(legacy_validate_html, html, args.iterations)
+            after = per_call_ms(validate_html, html, args.iterations)
+            print(f'{layout:>8} {size_kb:>4} KB: regex scans {before:8.2f} ms -> linter {after:8.2f} ms')
+
+if __name__ == '__main__':
+    main()
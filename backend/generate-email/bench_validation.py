@@ -0,0 +1,80 @@
+'''
+Business: Micro-benchmark of per-request contract validation in generate-email
+Args: --iterations N (default 2000), --html-kb K size of html_content in the output sample (default 100)
+Returns: prints per-call overhead of building a validator per request vs validators compiled once at import
+'''
+import argparse
+import json
+import os
+import time
+
+import fastjsonschema
+
+from index import resolve_refs
+
+CONTRACT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CONTRACT.json')
+
+def load_schemas():
+    with open(CONTRACT_PATH, encoding='utf-8') as contract_file:
+        contract = json.load(contract_file)
+    return (
+        resolve_refs(contract['inputSchema'], contract),
+        resolve_refs(contract['outputSchema'], contract),
+        contract['examples']['full_pain_sale']
+    )
+
+def sample_output(html_kb: int) -> dict:
+    return {
+        'subject': 'Как удержать персонал без высоких зарплат',
+        'preheader': 'Разбираем рабочие инструменты удержания на HUMAN',
+        'fields': {'headline': 'Удержание без бюджета', 'intro': 'Текучка 40%+ — не приговор.', 'cta_text': 'Узнать решение'},
+        'html_content': '<tr><td>Блок письма</td></tr>' * (html_kb * 1024 // 30),
+        'content_validation': {'status': 'OK', 'errors': []},
+        'html_validation': {'is_valid': True, 'warnings': []},
+        'mapping_log': [
+            {'variable': f'var_{i}', 'source': 'Event.name', 'transform': '', 'result_preview': 'HUMAN'}
+            for i in range(12)
+        ],
+        'recipe_used': 'pain_sale',
+        'recipe_version': '1.0.0',
+        'transform_version': '1.0.0',
+        'inputs_hash': '0123456789abcdef'
+    }
+
+def per_call_us(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--html-kb', type=int, default=100)
+    args = parser.parse_args()
+
+    input_schema, output_schema, body = load_schemas()
+    output = sample_output(args.html_kb)
+
+    compile_started = time.perf_counter()
+    validate_input = fastjsonschema.compile(input_schema)
+    validate_output = fastjsonschema.compile(output_schema)
+    compile_ms = (time.perf_counter() - compile_started) * 1000
+
+    results = {
+        'input': (
+            per_call_us(lambda: fastjsonschema.validate(input_schema, body), args.iterations),
+            per_call_us(lambda: validate_input(body), args.iterations)
+        ),
+        'output': (
+            per_call_us(lambda: fastjsonschema.validate(output_schema, output), args.iterations),
+            per_call_us(lambda: validate_output(output), args.iterations)
+        )
+    }
+
+    print(f'one-time compile: {compile_ms:.1f} ms, html_content: {args.html_kb} KB, iterations: {args.iterations}')
+    for name, (before, after) in results.items():
+        print(f'{name:>6}: validate per request {before:9.1f} us/call -> compiled once {after:7.1f} us/call ({before / after:.0f}x)')
+
+if __name__ == '__main__':
+    main()
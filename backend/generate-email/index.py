@@ -6,161 +6,185 @@ Returns: HTTP response dict с типизированным выходом + map
 '''
 import json
 import os
+import time
 import re
+import struct
+import threading
 import hashlib
-from typing import Dict, Any, List, Optional
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Container
 from datetime import datetime
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import openai
 import httpx
-from jsonschema import validate, ValidationError as JSONValidationError
+import fastjsonschema
+import numpy as np
+import tiktoken
+from fastjsonschema import JsonSchemaValueException as JSONValidationError
 
 RECIPE_VERSION = "1.0.0"
 TRANSFORM_VERSION = "1.0.0"
 
-INPUT_SCHEMA = {
-    "$id": "generate-email-input",
-    "type": "object",
-    "required": ["template_id", "event_id", "content_type_code", "mappings"],
-    "properties": {
-        "template_id": {"type": "integer"},
-        "event_id": {"type": "integer"},
-        "content_type_code": {"type": "string", "enum": ["announce", "sale", "pain_sale"]},
-        "content_plan": {
-            "type": "object",
-            "required": ["topic"],
-            "properties": {"topic": {"type": "string"}}
-        },
-        "pain": {
-            "type": "object",
-            "properties": {
-                "segment": {"type": "string"},
-                "pains": {"type": "array", "items": {"type": "string"}},
-                "triggers": {"type": "array", "items": {"type": "string"}}
-            }
-        },
-        "mappings": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "required": ["variable", "source"],
-                "properties": {
-                    "variable": {"type": "string"},
-                    "source": {"type": "string"},
-                    "transform": {"type": "string"},
-                    "value": {"type": ["string", "object", "array", "null"]}
-                }
-            }
-        },
-        "recipe_version": {"type": "string"},
-        "transform_version": {"type": "string"}
-    },
-    "additionalProperties": False
-}
-
-OUTPUT_SCHEMA = {
-    "$id": "generate-email-output",
-    "type": "object",
-    "required": ["subject", "preheader", "html_content", "content_validation", "html_validation", "recipe_used"],
-    "properties": {
-        "subject": {"type": "string", "maxLength": 55},
-        "preheader": {"type": "string", "minLength": 35, "maxLength": 70},
-        "fields": {
-            "type": "object",
-            "properties": {
-                "headline": {"type": "string"},
-                "intro": {"type": "string"},
-                "offer": {"type": "string"},
-                "speakers_block": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "name": {"type": "string"},
-                            "role": {"type": "string"},
-                            "thesis": {"type": "string"}
-                        }
-                    }
-                },
-                "cta_text": {"type": "string"},
-                "cta_url": {"type": "string"},
-                "cta_text_2": {"type": "string"},
-                "cta_url_2": {"type": "string"}
-            },
-            "additionalProperties": True
-        },
-        "html_content": {"type": "string"},
-        "content_validation": {
-            "type": "object",
-            "required": ["status", "errors"],
-            "properties": {
-                "status": {"type": "string", "enum": ["OK", "ERROR"]},
-                "errors": {
-                    "type": "array",
-                    "items": {
-                        "type": "object",
-                        "properties": {
-                            "field": {"type": "string"},
-                            "issue": {"type": "string"}
-                        }
-                    }
-                }
-            }
-        },
-        "html_validation": {
-            "type": "object",
-            "required": ["is_valid", "warnings"],
-            "properties": {
-                "is_valid": {"type": "boolean"},
-                "warnings": {"type": "array", "items": {"type": "string"}}
-            }
-        },
-        "mapping_log": {
-            "type": "array",
-            "items": {
-                "type": "object",
-                "properties": {
-                    "variable": {"type": "string"},
-                    "source": {"type": "string"},
-                    "transform": {"type": "string"},
-                    "result_preview": {"type": "string"}
-                }
-            }
-        },
-        "recipe_used": {"type": "string"}
-    },
-    "additionalProperties": False
-}
-
-RECIPES = {
-    "announce": {
-        "tone": "информативный, лаконичный, без давления",
-        "limits": {"subjectMax": 55, "preheaderMin": 35, "preheaderMax": 70},
-        "must": ["чёткая выгода", "дата/место или формат", "1 CTA"],
-        "min_fields": ["headline", "intro", "cta_text", "cta_url"]
-    },
-    "sale": {
-        "tone": "деловой, ориентированный на выгоду",
-        "limits": {"subjectMax": 55, "preheaderMin": 35, "preheaderMax": 70},
-        "must": ["оффер с дедлайном", "соцдоказательство", "1 CTA"],
-        "min_fields": ["headline", "intro", "offer", "cta_text", "cta_url"]
-    },
-    "pain_sale": {
-        "tone": "эмпатичный, конкретный, без перегиба",
-        "limits": {"subjectMax": 55, "preheaderMin": 35, "preheaderMax": 70},
-        "must": ["одна ключевая боль", "решение через ивент", "дедлайн", "1 CTA"],
-        "min_fields": ["headline", "intro", "offer", "cta_text", "cta_url"]
-    }
-}
+CONTRACT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CONTRACT.json')
+
+# CONTRACT.json is the single source for schemas and recipes
+with open(CONTRACT_PATH, encoding='utf-8') as contract_file:
+    CONTRACT = json.load(contract_file)
+
+def resolve_refs(node: Any, root: Dict) -> Any:
+    '''Inline local "#/..." references so each contract schema compiles standalone'''
+    if isinstance(node, dict):
+        if '$ref' in node:
+            target = root
+            for part in node['$ref'].lstrip('#/').split('/'):
+                target = target[part]
+            return resolve_refs(target, root)
+        return {key: resolve_refs(value, root) for key, value in node.items()}
+    if isinstance(node, list):
+        return [resolve_refs(value, root) for value in node]
+    return node
+
+INPUT_SCHEMA = resolve_refs(CONTRACT['inputSchema'], CONTRACT)
+OUTPUT_SCHEMA = resolve_refs(CONTRACT['outputSchema'], CONTRACT)
+BATCH_INPUT_SCHEMA = resolve_refs(CONTRACT['batchInputSchema'], CONTRACT)
+
+# Compiled to plain Python once per cold start instead of building a validator on every request
+validate_input = fastjsonschema.compile(INPUT_SCHEMA)
+validate_output = fastjsonschema.compile(OUTPUT_SCHEMA)
+validate_batch_input = fastjsonschema.compile(BATCH_INPUT_SCHEMA)
+
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+
+RECIPES = CONTRACT['recipes']
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[openai.OpenAI] = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> openai.OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+            http_client = httpx.Client(
+                proxy=proxy_url or None,
+                http2=True,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+            )
+            _openai_client = openai.OpenAI(
+                api_key=os.environ['OPENAI_API_KEY'],
+                http_client=http_client,
+                max_retries=OPENAI_MAX_RETRIES
+            )
+    return _openai_client
+
+# Delivery flags that do not change the generated result
+NON_INPUT_KEYS = ('no_cache', 'progress_id')
 
 def compute_inputs_hash(data: Dict) -> str:
-    content = json.dumps(data, sort_keys=True)
+    content = json.dumps({k: v for k, v in data.items() if k not in NON_INPUT_KEYS}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+def rows_version(rows: Any) -> str:
+    content = json.dumps(rows, sort_keys=True, default=str)
     return hashlib.sha256(content.encode()).hexdigest()[:16]
 
+def compute_cache_key(inputs_hash: str, template_html: str, event_row: Dict, knowledge: List[Dict], recipe: Dict) -> str:
+    # Any edit to the template, event or knowledge rows, recipe or transforms produces a new key
+    parts = {
+        'inputs_hash': inputs_hash,
+        'template': hashlib.sha256(template_html.encode()).hexdigest(),
+        'event': rows_version(event_row),
+        'knowledge': rows_version(sorted(knowledge, key=lambda item: str(item.get('id')))),
+        'recipe': rows_version(recipe),
+        'recipe_version': RECIPE_VERSION,
+        'transform_version': TRANSFORM_VERSION
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+# Describe one particular call, not the generated email: never stored, never served from the cache
+PER_CALL_OUTPUT_KEYS = ('cache', 'prompt_usage')
+
+def cacheable_output(output: Dict) -> Dict:
+    return {key: value for key, value in output.items() if key not in PER_CALL_OUTPUT_KEYS}
+
+def load_cached_output(cur, cache_key: str) -> Optional[Dict]:
+    cur.execute(
+        """UPDATE generation_cache SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+           WHERE cache_key = %s RETURNING output""",
+        (cache_key,)
+    )
+    row = cur.fetchone()
+    return cacheable_output(row['output']) if row else None
+
+def store_cached_output(cur, cache_key: str, inputs_hash: str, template_id: int, event_id: int, output: Dict):
+    cur.execute(
+        """INSERT INTO generation_cache
+           (cache_key, inputs_hash, template_id, event_id, recipe_version, transform_version, output)
+           VALUES (%s, %s, %s, %s, %s, %s, %s)
+           ON CONFLICT (cache_key) DO UPDATE SET output = EXCLUDED.output, created_at = CURRENT_TIMESTAMP""",
+        (cache_key, inputs_hash, template_id, event_id, RECIPE_VERSION, TRANSFORM_VERSION, json.dumps(cacheable_output(output)))
+    )
+
 def preview_value(value: Any, max_len: int = 80) -> str:
     str_val = str(value)
     if len(str_val) > max_len:
@@ -220,36 +244,208 @@ def render_agenda_ul(agenda: List[Dict]) -> str:
     
     return f'<ul style="line-height: 1.8;">{"".join(items)}</ul>'
 
-def short_intro(event: Dict, content_plan: Dict, knowledge: List[Dict]) -> str:
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+DEFAULT_CONTEXT_BUDGET = 1500
+# Share of the budget for event-level rows, which go to the prompt prefix and do not depend on the topic
+EVENT_CONTEXT_SHARE = 0.5
+
+# Tokenizer of gpt-4o-mini, the model both prompts are sent to
+TOKEN_ENCODING = 'o200k_base'
+# Tokenizer and input limits of EMBEDDING_MODEL; batches are bounded like rag-vectorize does
+EMBEDDING_ENCODING = 'cl100k_base'
+EMBEDDING_MAX_TOKENS = 8191
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_TOKENS = 100000
+
+_token_encodings: Dict[str, Any] = {}
+_token_encoding_lock = threading.Lock()
+
+def get_token_encoding(name: str = TOKEN_ENCODING):
+    with _token_encoding_lock:
+        if name not in _token_encodings:
+            try:
+                _token_encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                # The BPE file is fetched once per cold start; without it fall back to the estimate below
+                print(json.dumps({'token_encoding_unavailable': name, 'error': str(e)}))
+                _token_encodings[name] = False
+    return _token_encodings[name] or None
+
+def count_tokens(text: str, encoding_name: str = TOKEN_ENCODING) -> int:
+    encoding = get_token_encoding(encoding_name)
+    if encoding:
+        return len(encoding.encode(text))
+    # Upper bound: o200k averages about 3 characters per token for Russian and 4 for English,
+    # so counting 2 over-estimates and the packed context never exceeds the budget
+    return len(text) // 2 + 1
+
+def truncate_for_embedding(text: str) -> str:
+    '''Cut a text to the embedding model's input limit instead of failing the whole request on it'''
+    encoding = get_token_encoding(EMBEDDING_ENCODING)
+    if encoding:
+        tokens = encoding.encode(text)
+        return encoding.decode(tokens[:EMBEDDING_MAX_TOKENS]) if len(tokens) > EMBEDDING_MAX_TOKENS else text
+    # Without the tokenizer a UTF-8 byte is the only safe upper bound for a token
+    data = text.encode('utf-8')
+    return data[:EMBEDDING_MAX_TOKENS].decode('utf-8', 'ignore') if len(data) > EMBEDDING_MAX_TOKENS else text
+
+def make_embedding_batches(texts: List[str]) -> List[List[int]]:
+    '''Indexes of texts grouped by input count and estimated tokens'''
+    batches = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text, EMBEDDING_ENCODING)
+        if current and (len(current) >= EMBEDDING_BATCH_SIZE or current_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+# Same key and byte layout as the other embedding_cache writers (rag-embed, rag-search, rag-vectorize)
+def pack_embedding(values: List[float]) -> bytes:
+    return struct.pack(f'<{len(values)}f', *values)
+
+def unpack_embedding(data) -> List[float]:
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode()).hexdigest()
+
+def embed_texts(cur, texts: List[str]) -> List[List[float]]:
+    '''Embeddings from the shared embedding_cache table; only missing texts go to the API, in bounded batches.
+    No in-process LRU here: knowledge matrices are kept in _knowledge_index_cache and a batch embeds each topic once'''
+    vectors: List[Any] = [None] * len(texts)
+    unresolved: Dict[str, List[int]] = {}
+    for i, text in enumerate(texts):
+        unresolved.setdefault(text_hash(text), []).append(i)
     
-    if proxy_url:
-        http_client = httpx.Client(
-            proxies={
-                'http://': proxy_url,
-                'https://': proxy_url
-            }
-        )
-        client = openai.OpenAI(
-            api_key=os.environ['OPENAI_API_KEY'],
-            http_client=http_client
+    cur.execute(
+        """SELECT text_hash, embedding_bin FROM embedding_cache
+        WHERE model = %s AND text_hash = ANY(%s)""",
+        (EMBEDDING_MODEL, list(unresolved))
+    )
+    for row in cur.fetchall():
+        vector = unpack_embedding(row['embedding_bin'])
+        for i in unresolved.pop(row['text_hash'], []):
+            vectors[i] = vector
+    
+    if unresolved:
+        digests = list(unresolved)
+        inputs = [truncate_for_embedding(texts[unresolved[digest][0]]) for digest in digests]
+        client = get_openai_client()
+        rows = []
+        for batch in make_embedding_batches(inputs):
+            response = client.embeddings.create(model=EMBEDDING_MODEL, input=[inputs[j] for j in batch])
+            for item in response.data:
+                digest = digests[batch[item.index]]
+                for i in unresolved[digest]:
+                    vectors[i] = item.embedding
+                rows.append((EMBEDDING_MODEL, digest, psycopg2.Binary(pack_embedding(item.embedding)), len(item.embedding)))
+        
+        execute_values(
+            cur,
+            """INSERT INTO embedding_cache
+            (model, text_hash, embedding_bin, embedding_dim) VALUES %s
+            ON CONFLICT DO NOTHING""",
+            rows
         )
-    else:
-        client = openai.OpenAI(api_key=os.environ['OPENAI_API_KEY'])
     
-    knowledge_text = '\n\n'.join([
-        f"[{item.get('title', '')}]\n{item.get('content', '')}"
-        for item in knowledge
-    ])
+    return vectors
+
+def normalize_rows(vectors: List[List[float]]) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+KNOWLEDGE_INDEX_CACHE_SIZE = 16
+
+# Pre-normalized float32 matrices of an event's knowledge rows, keyed by the hash of their texts
+_knowledge_index_cache: OrderedDict = OrderedDict()
+
+def knowledge_matrix(cur, texts: List[str]) -> np.ndarray:
+    '''Stored embeddings of the knowledge rows as one matrix, the same layout rag-search ranks against'''
+    key = text_hash('\x00'.join(texts))
+    matrix = _knowledge_index_cache.get(key)
+    if matrix is not None:
+        _knowledge_index_cache.move_to_end(key)
+        return matrix
+    
+    matrix = normalize_rows(embed_texts(cur, texts))
+    _knowledge_index_cache[key] = matrix
+    if len(_knowledge_index_cache) > KNOWLEDGE_INDEX_CACHE_SIZE:
+        _knowledge_index_cache.popitem(last=False)
+    return matrix
+
+def knowledge_item_text(item: Dict) -> str:
+    return f"[{item.get('title', '')}]\n{item.get('content', '')}"
+
+def rank_knowledge(cur, knowledge: List[Dict], topic: str, budget: int) -> List[Dict]:
+    '''Order knowledge rows by similarity to the topic; rows that already fit the budget keep their order'''
+    texts = [knowledge_item_text(item) for item in knowledge]
+    if not topic or sum(count_tokens(text) for text in texts) <= budget:
+        return [dict(item) for item in knowledge]
+    
+    matrix = knowledge_matrix(cur, texts)
+    scores = matrix @ normalize_rows(embed_texts(cur, [topic]))[0]
+    order = np.argsort(-scores, kind='stable')
+    return [{**knowledge[i], 'relevance': round(float(scores[i]), 4)} for i in order]
+
+def pack_knowledge(knowledge: List[Dict], budget: int) -> tuple[List[Dict], Dict[str, Any]]:
+    '''Split the budget: event-level rows picked in id order regardless of the topic, then the best-ranked rest'''
+    tokens = [count_tokens(knowledge_item_text(item)) for item in knowledge]
+    # A set that fits whole is event-level; otherwise only part of the budget is reserved for the event-level rows
+    event_budget = budget if sum(tokens) <= budget else int(budget * EVENT_CONTEXT_SHARE)
+    placements: Dict[int, str] = {}
+    used_tokens = 0
+    for i in sorted(range(len(knowledge)), key=lambda i: (knowledge[i].get('id') or 0, knowledge[i].get('title') or '')):
+        if used_tokens + tokens[i] <= event_budget:
+            placements[i] = 'event'
+            used_tokens += tokens[i]
+    for i in range(len(knowledge)):
+        if i not in placements and used_tokens + tokens[i] <= budget:
+            placements[i] = 'topic'
+            used_tokens += tokens[i]
+    
+    packed = []
+    report = {'budget_tokens': budget, 'used_tokens': used_tokens, 'included': [], 'dropped': []}
+    for i, item in enumerate(knowledge):
+        entry = {'id': item.get('id'), 'title': item.get('title', ''), 'tokens': tokens[i]}
+        if 'relevance' in item:
+            entry['relevance'] = item['relevance']
+        if i in placements:
+            entry['placement'] = placements[i]
+            packed.append({**item, 'placement': placements[i]})
+            report['included'].append(entry)
+        else:
+            report['dropped'].append(entry)
+    
+    return packed, report
+
+def knowledge_part(knowledge: List[Dict], placement: str) -> List[Dict]:
+    return [item for item in knowledge if item.get('placement', 'event') == placement]
+
+def topic_knowledge_text(knowledge: List[Dict]) -> str:
+    topic_items = knowledge_part(knowledge, 'topic')
+    if not topic_items:
+        return ''
+    return '\n\nБАЗА ЗНАНИЙ ПО ТЕМЕ:\n' + '\n\n'.join(knowledge_item_text(item) for item in topic_items)
+
+def short_intro(event: Dict, content_plan: Dict, knowledge: List[Dict]) -> str:
+    client = get_openai_client()
     
     topic = content_plan.get('topic', '')
     event_name = event.get('name', '')
     
-    prompt = f"""Событие: {event_name}
-Тема письма: {topic}
+    prefix = f"""Событие: {event_name}
 
 База знаний:
-{knowledge_text}
+{stable_knowledge_text(knowledge_part(knowledge, 'event'))}
 
 Напиши короткое вступление для email-письма (2-3 предложения). Вступление должно:
 - Зацепить читателя проблемой или фактом
@@ -261,10 +457,12 @@ def short_intro(event: Dict, content_plan: Dict, knowledge: List[Dict]) -> str:
     response = client.chat.completions.create(
         model="gpt-4o-mini",
         messages=[
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": prefix},
+            {"role": "user", "content": f"Тема письма: {topic}{topic_knowledge_text(knowledge)}"}
         ],
         temperature=0.7
     )
+    record_prompt_usage('short_intro', response.usage)
     
     return response.choices[0].message.content.strip()
 
@@ -277,6 +475,14 @@ def apply_transform(transform_name: str, value: Any, event: Dict, content_plan:
         return short_intro(event, content_plan, knowledge)
     return str(value)
 
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', '4'))
+
+# Shared across warm invocations; LLM-bound transforms and generate_missing_fields run here concurrently
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY)
+
+def is_llm_transform(transform_name: Optional[str]) -> bool:
+    return bool(transform_name) and transform_name.startswith('short_intro')
+
 def source_router(source: str, event: Dict, content_plan: Dict, pain: Optional[Dict]) -> Any:
     if source == 'static':
         return None
@@ -296,31 +502,42 @@ def apply_mappings(
     event: Dict,
     content_plan: Dict,
     pain: Optional[Dict],
-    knowledge: List[Dict]
+    knowledge: List[Dict],
+    executor: ThreadPoolExecutor = _llm_executor
 ) -> tuple[Dict[str, str], List[Dict]]:
-    result = {}
-    mapping_log = []
+    resolved = []
     
+    # CPU-bound transforms run inline, LLM-bound ones are submitted and awaited in mapping order
     for mapping in mappings:
-        var_name = mapping.get('variable')
         source = mapping.get('source')
         transform = mapping.get('transform')
-        static_value = mapping.get('value')
         
         if source == 'static':
-            value = static_value
+            value = mapping.get('value')
         else:
             value = source_router(source, event, content_plan, pain)
         
-        if transform:
+        if is_llm_transform(transform):
+            value = executor.submit(apply_transform, transform, value, event, content_plan, knowledge)
+        elif transform:
             value = apply_transform(transform, value, event, content_plan, knowledge)
         
+        resolved.append(value)
+    
+    result = {}
+    mapping_log = []
+    
+    for mapping, value in zip(mappings, resolved):
+        if isinstance(value, Future):
+            value = value.result()
+        
+        var_name = mapping.get('variable')
         result[var_name] = value if value is not None else ''
         
         mapping_log.append({
             'variable': var_name,
-            'source': source,
-            'transform': transform or '',
+            'source': mapping.get('source'),
+            'transform': mapping.get('transform') or '',
             'result_preview': preview_value(value)
         })
     
@@ -360,96 +577,128 @@ def validate_content(content: Dict[str, Any], recipe: Dict, required_vars: List[
         "errors": errors
     }
 
+GMAIL_CLIP_BYTES = 102 * 1024
+HTML_MIN_LENGTH = 100
+UNSUBSCRIBE_MARKERS = ('unsubscribe', 'отписаться', 'отписка')
+
+# Matched against the ASCII-lowercased UTF-8 bytes: literal prefixes keep each scan in the fast path
+LINK_RE = re.compile(rb'<a\b')
+CTA_LINK_RE = re.compile(rb'''<a\s[^>]*?href\s*=\s*["']?\s*http''')
+BUTTON_RE = re.compile(rb'<button\b')
+# One match per <img>; the group is empty when the tag has no non-empty alt
+IMG_ALT_RE = re.compile(rb'''<img\b(?=([^>]*\salt\s*=\s*(?:"\s*[^"\s]|'\s*[^'\s]|[^\s"'>]))?)''')
+EMPTY_HREF_RE = re.compile(rb'''href\s*=\s*(?:"\s*#?\s*"|'\s*#?\s*'|#(?=[\s/>]))''')
+ANCHOR_END_RE = re.compile(rb'<a\b|</a\s*>')
+
+class HTMLLinter:
+    '''Each check is one linear regex scan; only empty-href anchors are inspected further, up to their own </a>'''
+    def __init__(self):
+        self.placeholders: List[str] = []
+        self.size_bytes = 0
+        self.links = 0
+        self.cta_count = 0
+        self.empty_hrefs = 0
+        self.images = 0
+        self.images_missing_alt = 0
+    
+    def feed(self, html: str):
+        self.placeholders = PLACEHOLDER_RE.findall(html) if '{{' in html else []
+        data = html.encode('utf-8')
+        self.size_bytes = len(data)
+        lowered = data.lower()
+        self.links = len(LINK_RE.findall(lowered))
+        self.cta_count = len(CTA_LINK_RE.findall(lowered)) + len(BUTTON_RE.findall(lowered))
+        alts = IMG_ALT_RE.findall(lowered)
+        self.images = len(alts)
+        self.images_missing_alt = alts.count(b'')
+        for match in EMPTY_HREF_RE.finditer(lowered):
+            self.check_empty_href(data, lowered, match.start(), match.end())
+    
+    def check_empty_href(self, data: bytes, lowered: bytes, href_start: int, href_end: int):
+        tag_start = lowered.rfind(b'<', 0, href_start)
+        tag_end = lowered.find(b'>', href_end)
+        if tag_start < 0 or tag_end < 0 or not LINK_RE.match(lowered, tag_start) or b'>' in lowered[tag_start:href_start]:
+            return
+        if not lowered[href_start - 1:href_start].isspace():
+            return
+        # The anchor's text ends at its </a> or at the next <a>, so every byte is read at most twice
+        anchor_end = ANCHOR_END_RE.search(lowered, tag_end)
+        text_end = anchor_end.start() if anchor_end else len(lowered)
+        anchor_text = data[tag_start:text_end].decode('utf-8', 'ignore').lower()
+        if not any(marker in anchor_text for marker in UNSUBSCRIBE_MARKERS):
+            self.empty_hrefs += 1
+
 def validate_html(html: str) -> Dict[str, Any]:
+    linter = HTMLLinter()
+    linter.feed(html)
+    
+    size_bytes = linter.size_bytes
     warnings = []
     
-    unfilled = re.findall(r'\{\{([^}]+)\}\}', html)
-    if unfilled:
-        warnings.append(f'Незаполненные переменные: {", ".join(unfilled)}')
+    if linter.placeholders:
+        warnings.append(f'Незаполненные переменные: {", ".join(linter.placeholders)}')
     
-    empty_hrefs = re.findall(r'<a[^>]+href="#"[^>]*>(?!.*unsubscribe)', html, re.IGNORECASE)
-    if empty_hrefs:
-        warnings.append(f'Найдено {len(empty_hrefs)} пустых href="#" (не unsubscribe)')
+    if linter.empty_hrefs:
+        warnings.append(f'Найдено {linter.empty_hrefs} пустых href="#" (не unsubscribe)')
     
-    if len(html) < 100:
-        warnings.append('HTML слишком короткий (менее 100 символов)')
+    if len(html) < HTML_MIN_LENGTH:
+        warnings.append(f'HTML слишком короткий (менее {HTML_MIN_LENGTH} символов)')
     
-    cta_patterns = [r'<a[^>]+href="http', r'<button']
-    has_valid_cta = any(re.search(pattern, html, re.IGNORECASE) for pattern in cta_patterns)
-    if not has_valid_cta:
+    if not linter.cta_count:
         warnings.append('Не найдено валидных CTA (ссылки или кнопки)')
     
+    if linter.images_missing_alt:
+        warnings.append(f'У {linter.images_missing_alt} изображений нет alt-текста')
+    
+    if size_bytes > GMAIL_CLIP_BYTES:
+        warnings.append(f'Размер письма {size_bytes // 1024} КБ превышает порог обрезки Gmail (102 КБ)')
+    
     return {
         "is_valid": len(warnings) == 0,
-        "warnings": warnings
+        "warnings": warnings,
+        "stats": {
+            "size_bytes": size_bytes,
+            "gmail_clip_bytes": GMAIL_CLIP_BYTES,
+            "links": linter.links,
+            "cta_count": linter.cta_count,
+            "empty_hrefs": linter.empty_hrefs,
+            "images": linter.images,
+            "images_missing_alt": linter.images_missing_alt,
+            "unfilled_placeholders": len(linter.placeholders)
+        }
     }
 
-def generate_missing_fields(
-    missing_fields: List[str],
-    knowledge: List[Dict],
-    recipe: Dict,
-    event: Dict,
-    content_plan: Dict,
-    pain: Optional[Dict] = None
-) -> Dict[str, Any]:
-    if not missing_fields:
-        return {"subject": content_plan.get('topic', 'Новое письмо'), "preheader": "", "fields": {}}
-    
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
-    
-    if proxy_url:
-        http_client = httpx.Client(
-            proxies={
-                'http://': proxy_url,
-                'https://': proxy_url
-            }
-        )
-        client = openai.OpenAI(
-            api_key=os.environ['OPENAI_API_KEY'],
-            http_client=http_client
-        )
-    else:
-        client = openai.OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-    
-    knowledge_text = '\n\n'.join([
-        f"[{item.get('title', '')}]\n{item.get('content', '')}"
-        for item in knowledge
-    ])
-    
+def stable_knowledge_text(knowledge: List[Dict]) -> str:
+    # Sorted by row id so the same event-level set always serializes to the same prompt prefix
+    ordered = sorted(knowledge, key=lambda item: (item.get('id') or 0, item.get('title') or ''))
+    return '\n\n'.join(knowledge_item_text(item) for item in ordered)
+
+def record_prompt_usage(call: str, usage: Any) -> Dict[str, int]:
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    record = {
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'uncached_tokens': prompt_tokens - cached_tokens,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0
+    }
+    print(json.dumps({'llm_usage': call, **record}))
+    return record
+
+def build_fields_prefix(recipe: Dict, event: Dict, knowledge: List[Dict]) -> str:
+    '''Recipe rules, format spec and event-level knowledge: identical for every request on the same event and recipe'''
     event_name = event.get('name', 'Событие')
-    topic = content_plan.get('topic', '')
     tone = recipe.get('tone', 'нейтральный')
     must_have = recipe.get('must', [])
     limits = recipe.get('limits', {})
     
-    pain_context = ""
-    if pain:
-        segment = pain.get('segment', '')
-        pains_list = pain.get('pains', [])
-        triggers_list = pain.get('triggers', [])
-        pain_context = f"""
-
-БОЛИ СЕГМЕНТА "{segment}":
-{chr(10).join([f'- {p}' for p in pains_list])}
-
-ТРИГГЕРЫ:
-{chr(10).join([f'- {t}' for t in triggers_list])}
-"""
-    
-    system_prompt = f"""Ты — копирайтер email-маркетинга.
-
-СОБЫТИЕ: {event_name}
-ТЕМА ПИСЬМА: {topic}
+    return f"""Ты — копирайтер email-маркетинга.
 
 РЕЦЕПТ:
 - Тон: {tone}
 - Обязательно: {', '.join(must_have)}
 - Лимиты: subject ≤{limits.get('subjectMax', 55)}, preheader {limits.get('preheaderMin', 35)}-{limits.get('preheaderMax', 70)}
-{pain_context}
-БАЗА ЗНАНИЙ:
-{knowledge_text}
-
-Заполни ТОЛЬКО эти поля: {', '.join(missing_fields)}
 
 Правила:
 1. Используй ТОЛЬКО информацию из базы знаний
@@ -468,31 +717,722 @@ def generate_missing_fields(
     "intro": "...",
     "speakers_block": [{{"name":"...","role":"...","thesis":"..."}}]
   }}
-}}"""
+}}
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Создай контент для: {', '.join(missing_fields)}"}
-        ],
-        temperature=0.7,
-        response_format={"type": "json_object"}
-    )
+СОБЫТИЕ: {event_name}
+
+БАЗА ЗНАНИЙ:
+{stable_knowledge_text(knowledge_part(knowledge, 'event'))}"""
+
+def build_fields_suffix(missing_fields: List[str], content_plan: Dict, pain: Optional[Dict], knowledge: List[Dict]) -> str:
+    topic = content_plan.get('topic', '')
     
-    result = json.loads(response.choices[0].message.content)
+    pain_context = ""
+    if pain:
+        segment = pain.get('segment', '')
+        pains_list = pain.get('pains', [])
+        triggers_list = pain.get('triggers', [])
+        pain_context = f"""
+БОЛИ СЕГМЕНТА "{segment}":
+{chr(10).join([f'- {p}' for p in pains_list])}
+
+ТРИГГЕРЫ:
+{chr(10).join([f'- {t}' for t in triggers_list])}
+"""
     
-    return result
+    return f"""ТЕМА ПИСЬМА: {topic}{topic_knowledge_text(knowledge)}
+{pain_context}
+Заполни ТОЛЬКО эти поля: {', '.join(missing_fields)}"""
 
-def fill_template(template: str, variables_data: Dict[str, str]) -> str:
-    result = template
-    for key, value in variables_data.items():
-        pattern = r'\{\{' + re.escape(key) + r'\}\}'
-        result = re.sub(pattern, str(value), result)
+def generate_missing_fields(
+    missing_fields: List[str],
+    knowledge: List[Dict],
+    recipe: Dict,
+    event: Dict,
+    content_plan: Dict,
+    pain: Optional[Dict] = None,
+    progress: Optional['ProgressWriter'] = None
+) -> Dict[str, Any]:
+    if not missing_fields:
+        return {"subject": content_plan.get('topic', 'Новое письмо'), "preheader": "", "fields": {}}
+    
+    client = get_openai_client()
+    
+    # Stable prefix first so provider-side prompt caching can reuse it across topics and batch items
+    messages = [
+        {"role": "system", "content": build_fields_prefix(recipe, event, knowledge)},
+        {"role": "user", "content": build_fields_suffix(missing_fields, content_plan, pain, knowledge)}
+    ]
+    
+    params = {
+        'model': "gpt-4o-mini",
+        'messages': messages,
+        'temperature': 0.7,
+        'response_format': {"type": "json_object"}
+    }
+    if progress is None:
+        response = client.chat.completions.create(**params)
+        content, usage = response.choices[0].message.content, response.usage
+    else:
+        progress.track_fields(['subject', 'preheader', *missing_fields])
+        content, usage = stream_completion(client, progress, params)
+    
+    result = json.loads(content)
+    result['usage'] = record_prompt_usage('generate_missing_fields', usage)
     return result
 
-def get_unfilled_variables(html: str) -> List[str]:
-    return re.findall(r'\{\{([^}]+)\}\}', html)
+def stream_completion(client, progress: 'ProgressWriter', params: Dict[str, Any]) -> tuple[str, Any]:
+    '''The same completion with stream=True; deltas reach the progress row while the model is still writing'''
+    parts = []
+    usage = None
+    for chunk in client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **params):
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            progress.append(chunk.choices[0].delta.content)
+    progress.flush()
+    return ''.join(parts), usage
+
+PLACEHOLDER_RE = re.compile(r'\{\{([^}]+)\}\}')
+TEMPLATE_CACHE_SIZE = 64
+
+class CompiledTemplate:
+    def __init__(self, source: str):
+        self.literals: List[str] = []
+        self.slots: List[str] = []
+        pos = 0
+        for match in PLACEHOLDER_RE.finditer(source):
+            self.literals.append(source[pos:match.start()])
+            self.slots.append(match.group(1))
+            pos = match.end()
+        self.literals.append(source[pos:])
+    
+    def unfilled(self, values: Container[str]) -> List[str]:
+        return [slot for slot in self.slots if slot not in values]
+    
+    def render(self, values: Dict[str, Any]) -> str:
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            if slot in values:
+                parts.append(str(values[slot]))
+            else:
+                parts.append('{{' + slot + '}}')
+            parts.append(literal)
+        return ''.join(parts)
+
+_template_cache: OrderedDict = OrderedDict()
+# render_email runs on batch and LLM worker threads; OrderedDict reordering is not atomic
+_template_cache_lock = threading.Lock()
+
+def get_compiled_template(template_id: int, html: str) -> CompiledTemplate:
+    key = (template_id, hashlib.sha256(html.encode()).hexdigest())
+    with _template_cache_lock:
+        compiled = _template_cache.get(key)
+        if compiled is not None:
+            _template_cache.move_to_end(key)
+            return compiled
+    
+    compiled = CompiledTemplate(html)
+    with _template_cache_lock:
+        _template_cache[key] = compiled
+        _template_cache.move_to_end(key)
+        if len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return compiled
+
+def render_email(
+    spec: Dict,
+    template: Dict,
+    event_dict: Dict,
+    knowledge: List[Dict],
+    inputs_hash: str,
+    llm_executor: ThreadPoolExecutor = _llm_executor,
+    progress: Optional['ProgressWriter'] = None
+) -> Dict[str, Any]:
+    content_type_code = spec.get('content_type_code', 'announce')
+    content_plan = spec.get('content_plan', {})
+    pain = spec.get('pain')
+    mappings = spec.get('mappings', [])
+    recipe = RECIPES.get(content_type_code, RECIPES['announce'])
+    
+    # knowledge arrives ranked by rank_knowledge; both LLM calls see only what fits the recipe budget
+    knowledge, knowledge_report = pack_knowledge(knowledge, recipe.get('context_budget', DEFAULT_CONTEXT_BUDGET))
+    
+    compiled = get_compiled_template(template['id'], template['html_content'])
+    all_required_vars = compiled.slots
+    
+    # Missing fields depend only on which variables are mapped, so generation overlaps the mapping transforms
+    missing_fields = compiled.unfilled({mapping.get('variable') for mapping in mappings})
+    
+    generated_future = None
+    if missing_fields:
+        generated_future = llm_executor.submit(
+            generate_missing_fields,
+            missing_fields,
+            knowledge,
+            recipe,
+            event_dict,
+            content_plan,
+            pain,
+            progress
+        )
+    
+    filled_vars, mapping_log = apply_mappings(mappings, event_dict, content_plan, pain, knowledge, llm_executor)
+    
+    generated = generated_future.result() if generated_future else {}
+    prompt_usage = generated.pop('usage', None)
+    
+    all_fields = {**filled_vars, **generated.get('fields', {})}
+    
+    if 'speakers_block' in all_fields and isinstance(all_fields['speakers_block'], list):
+        all_fields['speakers_block'] = render_speakers_cards(all_fields['speakers_block'])
+    
+    final_html = compiled.render(all_fields)
+    
+    if not all_fields.get('speakers_block'):
+        final_html = re.sub(
+            r'<!-- Спикеры -->.*?<!-- CTA -->',
+            '<!-- CTA -->',
+            final_html,
+            flags=re.DOTALL
+        )
+    
+    subject = generated.get('subject', content_plan.get('topic', 'Новое письмо'))
+    preheader = generated.get('preheader', '')
+    
+    all_content = {
+        'subject': subject,
+        'preheader': preheader,
+        **all_fields
+    }
+    
+    content_validation = validate_content(all_content, recipe, all_required_vars)
+    html_validation = validate_html(final_html)
+    
+    output = {
+        'subject': subject,
+        'preheader': preheader,
+        'fields': all_fields,
+        'html_content': final_html,
+        'content_validation': content_validation,
+        'html_validation': html_validation,
+        'mapping_log': mapping_log,
+        'recipe_used': content_type_code,
+        'recipe_version': RECIPE_VERSION,
+        'transform_version': TRANSFORM_VERSION,
+        'inputs_hash': inputs_hash,
+        'knowledge_context': knowledge_report
+    }
+    if prompt_usage:
+        output['prompt_usage'] = prompt_usage
+    
+    try:
+        validate_output(output)
+    except JSONValidationError as e:
+        output['output_schema_warning'] = f'Output validation failed: {e.message}'
+    
+    return output
+
+def load_campaign_specs(cur, campaign_id: int) -> tuple[Optional[Dict], List[Dict]]:
+    cur.execute("SELECT * FROM campaigns WHERE id = %s", (campaign_id,))
+    campaign = cur.fetchone()
+    if not campaign:
+        return None, []
+    
+    cur.execute(
+        """SELECT ce.id, ce.template_id, ce.content_type_id, ce.subject, ce.send_order, ct.code AS content_type_code
+           FROM campaign_emails ce
+           LEFT JOIN content_types ct ON ct.id = ce.content_type_id
+           WHERE ce.campaign_id = %s
+           ORDER BY ce.send_order NULLS LAST, ce.id""",
+        (campaign_id,)
+    )
+    emails = cur.fetchall()
+    
+    cur.execute(
+        """SELECT template_id, content_type_id, variable, source, transform, value
+           FROM template_mappings
+           WHERE template_id = ANY(%s)
+           ORDER BY id""",
+        (list({email['template_id'] for email in emails}),)
+    )
+    mappings_by_key: Dict[tuple, List[Dict]] = {}
+    for row in cur.fetchall():
+        mapping = {'variable': row['variable'], 'source': row['source']}
+        if row['transform']:
+            mapping['transform'] = row['transform']
+        if row['source'] == 'static':
+            mapping['value'] = row['value']
+        mappings_by_key.setdefault((row['template_id'], row['content_type_id']), []).append(mapping)
+    
+    specs = []
+    for email in emails:
+        specs.append({
+            'campaign_email_id': email['id'],
+            'send_order': email['send_order'],
+            'template_id': email['template_id'],
+            'content_type_code': email['content_type_code'] or 'announce',
+            'content_plan': {'topic': email['subject'] or campaign['name']},
+            'mappings': mappings_by_key.get((email['template_id'], email['content_type_id']), [])
+        })
+    return campaign, specs
+
+def load_cached_outputs(cur, cache_keys: List[str]) -> Dict[str, Dict]:
+    cur.execute(
+        """UPDATE generation_cache SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+           WHERE cache_key = ANY(%s) RETURNING cache_key, output""",
+        (cache_keys,)
+    )
+    return {row['cache_key'].strip(): cacheable_output(row['output']) for row in cur.fetchall()}
+
+def store_cached_outputs(cur, rows: List[tuple]):
+    if not rows:
+        return
+    execute_values(
+        cur,
+        """INSERT INTO generation_cache
+           (cache_key, inputs_hash, template_id, event_id, recipe_version, transform_version, output)
+           VALUES %s
+           ON CONFLICT (cache_key) DO UPDATE SET output = EXCLUDED.output, created_at = CURRENT_TIMESTAMP""",
+        rows
+    )
+
+def write_campaign_emails(cur, campaign_id: Optional[int], items: List[Dict]) -> Dict[str, int]:
+    updates = []
+    inserts = []
+    for item in items:
+        output = item.get('output')
+        if not output:
+            continue
+        validation_status = json.dumps({
+            'content_validation': output['content_validation'],
+            'html_validation': output['html_validation']
+        })
+        subject = output['subject'][:255]
+        if item['spec'].get('campaign_email_id'):
+            updates.append((
+                item['spec']['campaign_email_id'], campaign_id, subject, output['html_content'], validation_status
+            ))
+        elif campaign_id:
+            inserts.append((item, subject, validation_status))
+    
+    if updates:
+        execute_values(
+            cur,
+            """UPDATE campaign_emails AS ce
+               SET subject = v.subject, generated_html = v.html, validation_status = v.status::jsonb,
+                   updated_at = CURRENT_TIMESTAMP
+               FROM (VALUES %s) AS v(id, campaign_id, subject, html, status)
+               WHERE ce.id = v.id AND ce.campaign_id = v.campaign_id""",
+            updates
+        )
+    
+    if inserts:
+        # New emails go after everything the campaign already has; the campaign row lock serializes concurrent batches
+        cur.execute("SELECT id FROM campaigns WHERE id = %s FOR UPDATE", (campaign_id,))
+        cur.execute("SELECT COALESCE(MAX(send_order), 0) AS last_order FROM campaign_emails WHERE campaign_id = %s", (campaign_id,))
+        next_order = max([cur.fetchone()['last_order']] + [item['spec'].get('send_order') or 0 for item, _, _ in inserts])
+        rows = []
+        for item, subject, validation_status in inserts:
+            if item['spec'].get('send_order') is None:
+                next_order += 1
+                item['send_order'] = next_order
+            else:
+                item['send_order'] = item['spec']['send_order']
+            rows.append((
+                campaign_id,
+                item['spec']['template_id'],
+                item['spec'].get('content_type_code', 'announce'),
+                subject,
+                item['output']['html_content'],
+                validation_status,
+                item['send_order']
+            ))
+        
+        inserted = execute_values(
+            cur,
+            """INSERT INTO campaign_emails
+               (campaign_id, template_id, content_type_id, subject, generated_html, validation_status, send_order)
+               VALUES %s RETURNING id""",
+            rows,
+            template="(%s, %s, (SELECT id FROM content_types WHERE code = %s), %s, %s, %s::jsonb, %s)",
+            fetch=True
+        )
+        for (item, _, _), row in zip(inserts, inserted):
+            item['campaign_email_id'] = row['id']
+    
+    return {'updated': len(updates), 'inserted': len(inserts)}
+
+def start_batch_status(cur, batch_id: str, campaign_id: Optional[int], event_id: int, total: int):
+    cur.execute(
+        """INSERT INTO generation_batches (batch_id, campaign_id, event_id, status, total)
+           VALUES (%s, %s, %s, 'running', %s)
+           ON CONFLICT (batch_id) DO UPDATE SET
+               campaign_id = EXCLUDED.campaign_id, event_id = EXCLUDED.event_id, status = 'running',
+               total = EXCLUDED.total, done = 0, failed = 0, progress = '[]'::jsonb, error = NULL,
+               updated_at = CURRENT_TIMESTAMP""",
+        (batch_id, campaign_id, event_id, total)
+    )
+
+def record_batch_progress(cur, batch_id: str, entry: Dict):
+    cur.execute(
+        """UPDATE generation_batches
+           SET done = done + %s, failed = failed + %s, progress = progress || %s::jsonb,
+               updated_at = CURRENT_TIMESTAMP
+           WHERE batch_id = %s""",
+        (int(entry['status'] == 'done'), int(entry['status'] == 'error'), json.dumps([entry]), batch_id)
+    )
+
+def finish_batch_status(cur, batch_id: str, status: str, error: Optional[str] = None):
+    cur.execute(
+        "UPDATE generation_batches SET status = %s, error = %s, updated_at = CURRENT_TIMESTAMP WHERE batch_id = %s",
+        (status, error, batch_id)
+    )
+
+PROGRESS_FLUSH_SECONDS = float(os.environ.get('PROGRESS_FLUSH_SECONDS', '0.3'))
+
+def completed_string_fields(text: str, names: List[str]) -> Dict[str, str]:
+    '''String fields whose closing quote has already arrived in a partial JSON answer'''
+    fields = {}
+    for name in names:
+        match = re.search(r'"' + re.escape(name) + r'"\s*:\s*"((?:[^"\\]|\\.)*)"', text)
+        if match:
+            try:
+                fields[name] = json.loads(f'"{match.group(1)}"')
+            except ValueError:
+                continue
+    return fields
+
+class ProgressWriter:
+    '''Partial model output in generation_progress, committed on its own connection so GET ?progress_id= sees it mid-request.
+    The runtime buffers the HTTP response, polling this row is how the client gets fields before the POST returns'''
+    def __init__(self, progress_id: str):
+        self.progress_id = progress_id
+        self.text = ''
+        self.field_names: List[str] = []
+        self.flushed_at = 0.0
+        self.conn = get_db_connection()
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO generation_progress (progress_id, source, status)
+                   VALUES (%s, 'generate-email', 'running')
+                   ON CONFLICT (progress_id) DO UPDATE SET
+                       source = EXCLUDED.source, status = 'running', partial_text = '', fields = '{}'::jsonb,
+                       result = NULL, error = NULL, updated_at = CURRENT_TIMESTAMP""",
+                (progress_id,)
+            )
+    
+    def track_fields(self, names: List[str]):
+        self.field_names = names
+    
+    def append(self, delta: str):
+        self.text += delta
+        if time.monotonic() - self.flushed_at >= PROGRESS_FLUSH_SECONDS:
+            self.flush()
+    
+    def flush(self, status: str = 'running', result: Optional[Dict] = None, error: Optional[str] = None):
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """UPDATE generation_progress
+                   SET status = %s, partial_text = %s, fields = %s::jsonb, result = %s::jsonb, error = %s,
+                       updated_at = CURRENT_TIMESTAMP
+                   WHERE progress_id = %s""",
+                (
+                    status, self.text, json.dumps(completed_string_fields(self.text, self.field_names)),
+                    json.dumps(result) if result is not None else None, error, self.progress_id
+                )
+            )
+        self.flushed_at = time.monotonic()
+    
+    def finish(self, output: Dict):
+        # Terminal event: the checks the client would otherwise only see in the POST response
+        self.flush('done', {
+            'subject': output.get('subject'),
+            'preheader': output.get('preheader'),
+            'content_validation': output.get('content_validation'),
+            'html_validation': output.get('html_validation'),
+            'cache': output.get('cache')
+        })
+    
+    def fail(self, error: str):
+        try:
+            self.flush('failed', error=error)
+        except psycopg2.Error:
+            pass
+    
+    def close(self):
+        release_db_connection(self.conn)
+
+def handle_progress_status(progress_id: str) -> Dict[str, Any]:
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("SELECT * FROM generation_progress WHERE progress_id = %s", (progress_id,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    if not row:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Progress not found'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Cache-Control': 'no-store'},
+        'body': json.dumps(dict(row), default=str, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+def handle_batch_status(batch_id: str) -> Dict[str, Any]:
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("SELECT * FROM generation_batches WHERE batch_id = %s", (batch_id,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    
+    if not row:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Batch not found'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Cache-Control': 'no-store'},
+        'body': json.dumps(dict(row), default=str),
+        'isBase64Encoded': False
+    }
+
+def handle_batch(body_data: Dict) -> Dict[str, Any]:
+    started = time.time()
+    
+    try:
+        validate_batch_input(body_data)
+    except JSONValidationError as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Input validation failed: {e.message}'}),
+            'isBase64Encoded': False
+        }
+    
+    campaign_id = body_data.get('campaign_id')
+    event_id = body_data.get('event_id')
+    specs = body_data.get('specs')
+    no_cache = body_data.get('no_cache', False)
+    concurrency = body_data.get('concurrency', BATCH_CONCURRENCY)
+    batch_id = body_data.get('batch_id') or uuid.uuid4().hex
+    
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    try:
+        if campaign_id:
+            campaign, campaign_specs = load_campaign_specs(cur, campaign_id)
+            if not campaign:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Campaign not found'}),
+                    'isBase64Encoded': False
+                }
+            event_id = event_id or campaign['event_id']
+            if specs is None:
+                specs = campaign_specs
+        
+        if not campaign_id:
+            unbound = [index for index, spec in enumerate(specs) if spec.get('campaign_email_id')]
+            if unbound:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'error': 'campaign_email_id requires campaign_id',
+                        'spec_indexes': unbound
+                    }),
+                    'isBase64Encoded': False
+                }
+        
+        mismatched = [index for index, spec in enumerate(specs) if spec.get('event_id', event_id) != event_id]
+        if mismatched:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'error': f'Spec event_id does not match batch event_id {event_id}',
+                    'spec_indexes': mismatched
+                }),
+                'isBase64Encoded': False
+            }
+        
+        cur.execute("SELECT * FROM events WHERE id = %s", (event_id,))
+        event_row = cur.fetchone()
+        
+        if not event_row:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Event not found'}),
+                'isBase64Encoded': False
+            }
+        
+        cur.execute("SELECT * FROM knowledge_base WHERE event_id = %s ORDER BY id", (event_id,))
+        knowledge = cur.fetchall()
+        event_dict = dict(event_row)
+        
+        cur.execute(
+            "SELECT * FROM email_templates WHERE id = ANY(%s)",
+            (list({spec['template_id'] for spec in specs}),)
+        )
+        templates = {row['id']: row for row in cur.fetchall()}
+        
+        items = []
+        for index, spec in enumerate(specs):
+            spec = {**spec, 'event_id': event_id}
+            item = {'index': index, 'spec': spec, 'campaign_email_id': spec.get('campaign_email_id')}
+            template = templates.get(spec['template_id'])
+            if not template:
+                item['error'] = 'Template not found'
+            else:
+                hash_input = {k: v for k, v in spec.items() if k not in ('campaign_email_id', 'send_order')}
+                item['inputs_hash'] = compute_inputs_hash(hash_input)
+                recipe = RECIPES.get(spec.get('content_type_code', 'announce'), RECIPES['announce'])
+                item['cache_key'] = compute_cache_key(
+                    item['inputs_hash'], template['html_content'], event_dict, knowledge, recipe
+                )
+            items.append(item)
+        
+        # Committed up front so GET ?batch_id= sees the batch while it runs
+        start_batch_status(cur, batch_id, campaign_id, event_id, len(items))
+        conn.commit()
+        
+        cached = {}
+        if not no_cache:
+            cached = load_cached_outputs(cur, [item['cache_key'] for item in items if 'cache_key' in item])
+        
+        progress = []
+        
+        def report(item: Dict, status: str):
+            entry = {
+                'index': item['index'],
+                'campaign_email_id': item.get('campaign_email_id'),
+                'status': status,
+                'cache': item.get('cache'),
+                'elapsed_ms': int((time.time() - started) * 1000)
+            }
+            progress.append(entry)
+            record_batch_progress(cur, batch_id, entry)
+            conn.commit()
+        
+        pending = []
+        ranked_by_key: Dict[tuple, List[Dict]] = {}
+        for item in items:
+            if 'error' in item:
+                report(item, 'error')
+            elif item['cache_key'] in cached:
+                item['output'] = {**cached[item['cache_key']], 'cache': 'hit'}
+                item['cache'] = 'hit'
+                report(item, 'done')
+            else:
+                topic = item['spec'].get('content_plan', {}).get('topic', '')
+                recipe = RECIPES.get(item['spec'].get('content_type_code', 'announce'), RECIPES['announce'])
+                budget = recipe.get('context_budget', DEFAULT_CONTEXT_BUDGET)
+                if (topic, budget) not in ranked_by_key:
+                    ranked_by_key[(topic, budget)] = rank_knowledge(cur, knowledge, topic, budget)
+                item['knowledge'] = ranked_by_key[(topic, budget)]
+                pending.append(item)
+        
+        # Worker threads never touch the DB connection; shared rows are passed in read-only.
+        # LLM calls get their own pool sized from the batch, each email can have fields and short_intro in flight
+        with ThreadPoolExecutor(max_workers=concurrency) as batch_executor, \
+                ThreadPoolExecutor(max_workers=concurrency * 2) as batch_llm_executor:
+            futures = {
+                batch_executor.submit(
+                    render_email, item['spec'], templates[item['spec']['template_id']],
+                    event_dict, item['knowledge'], item['inputs_hash'], batch_llm_executor
+                ): item
+                for item in pending
+            }
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    item['output'] = {**future.result(), 'cache': 'miss'}
+                    item['cache'] = 'miss'
+                    report(item, 'done')
+                except Exception as e:
+                    item['error'] = str(e)
+                    report(item, 'error')
+        
+        store_cached_outputs(cur, [
+            (
+                item['cache_key'], item['inputs_hash'], item['spec']['template_id'], event_id,
+                RECIPE_VERSION, TRANSFORM_VERSION,
+                json.dumps(cacheable_output(item['output']))
+            )
+            for item in items if item.get('cache') == 'miss'
+        ])
+        written = write_campaign_emails(cur, campaign_id, items)
+        finish_batch_status(cur, batch_id, 'done')
+        conn.commit()
+        
+        emails = []
+        for item in items:
+            result = {
+                'index': item['index'],
+                'campaign_email_id': item.get('campaign_email_id'),
+                'send_order': item.get('send_order', item['spec'].get('send_order'))
+            }
+            if item.get('output'):
+                result.update(item['output'])
+            else:
+                result['error'] = item.get('error')
+            emails.append(result)
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({
+                'batch_id': batch_id,
+                'campaign_id': campaign_id,
+                'event_id': event_id,
+                'emails': emails,
+                'progress': progress,
+                'stats': {
+                    'total': len(items),
+                    'generated': sum(1 for item in items if item.get('cache') == 'miss'),
+                    'cached': sum(1 for item in items if item.get('cache') == 'hit'),
+                    'failed': sum(1 for item in items if not item.get('output')),
+                    **written
+                },
+                'concurrency': concurrency,
+                'elapsed_ms': int((time.time() - started) * 1000)
+            }),
+            'isBase64Encoded': False
+        }
+    except Exception as e:
+        # Recording the failure must not mask the original error when the connection itself is gone
+        try:
+            conn.rollback()
+            finish_batch_status(cur, batch_id, 'failed', str(e))
+            conn.commit()
+        except psycopg2.Error:
+            pass
+        raise
+    finally:
+        cur.close()
+        release_db_connection(conn)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -502,7 +1442,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type',
                 'Access-Control-Max-Age': '86400'
             },
@@ -510,6 +1450,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        if params.get('progress_id'):
+            return handle_progress_status(params['progress_id'])
+        if not params.get('batch_id'):
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'batch_id or progress_id is required'}),
+                'isBase64Encoded': False
+            }
+        return handle_batch_status(params['batch_id'])
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -521,8 +1474,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     try:
         body_data = json.loads(event.get('body', '{}'))
         
+        if body_data.get('batch'):
+            return handle_batch(body_data)
+        
         try:
-            validate(instance=body_data, schema=INPUT_SCHEMA)
+            validate_input(body_data)
         except JSONValidationError as e:
             return {
                 'statusCode': 400,
@@ -534,13 +1490,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         template_id = body_data.get('template_id')
         event_id = body_data.get('event_id')
         content_type_code = body_data.get('content_type_code', 'announce')
-        content_plan = body_data.get('content_plan', {})
-        pain = body_data.get('pain')
-        mappings = body_data.get('mappings', [])
+        no_cache = body_data.get('no_cache', False)
         
         recipe = RECIPES.get(content_type_code, RECIPES['announce'])
         inputs_hash = compute_inputs_hash(body_data)
         
+        # Committed before any lookups so a poll started together with this POST finds the row
+        progress = ProgressWriter(body_data['progress_id']) if body_data.get('progress_id') else None
+        
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
@@ -548,6 +1505,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         template = cur.fetchone()
         
         if not template:
+            if progress:
+                progress.fail('Template not found')
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -559,6 +1518,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         event_row = cur.fetchone()
         
         if not event_row:
+            if progress:
+                progress.fail('Event not found')
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -566,77 +1527,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        cur.execute("SELECT * FROM knowledge_base WHERE event_id = %s", (event_id,))
+        cur.execute("SELECT * FROM knowledge_base WHERE event_id = %s ORDER BY id", (event_id,))
         knowledge = cur.fetchall()
         
-        template_html = template['html_content']
         event_dict = dict(event_row)
         
-        all_required_vars = get_unfilled_variables(template_html)
-        
-        filled_vars, mapping_log = apply_mappings(mappings, event_dict, content_plan, pain, knowledge)
-        
-        partial_html = fill_template(template_html, filled_vars)
-        unfilled_vars = get_unfilled_variables(partial_html)
-        
-        missing_fields = [v for v in unfilled_vars if v not in filled_vars]
-        
-        generated = {}
-        if missing_fields:
-            generated = generate_missing_fields(
-                missing_fields,
-                knowledge,
-                recipe,
-                event_dict,
-                content_plan,
-                pain
-            )
-        
-        all_fields = {**filled_vars, **generated.get('fields', {})}
+        cache_key = compute_cache_key(inputs_hash, template['html_content'], event_dict, knowledge, recipe)
         
-        if 'speakers_block' in all_fields and isinstance(all_fields['speakers_block'], list):
-            all_fields['speakers_block'] = render_speakers_cards(all_fields['speakers_block'])
-        
-        final_html = fill_template(template_html, all_fields)
-        
-        if not all_fields.get('speakers_block'):
-            final_html = re.sub(
-                r'<!-- Спикеры -->.*?<!-- CTA -->',
-                '<!-- CTA -->',
-                final_html,
-                flags=re.DOTALL
-            )
-        
-        subject = generated.get('subject', content_plan.get('topic', 'Новое письмо'))
-        preheader = generated.get('preheader', '')
+        if not no_cache:
+            cached_output = load_cached_output(cur, cache_key)
+            if cached_output is not None:
+                conn.commit()
+                if progress:
+                    progress.finish({**cached_output, 'cache': 'hit'})
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({**cached_output, 'cache': 'hit'}),
+                    'isBase64Encoded': False
+                }
         
-        all_content = {
-            'subject': subject,
-            'preheader': preheader,
-            **all_fields
-        }
+        ranked_knowledge = rank_knowledge(
+            cur,
+            knowledge,
+            body_data.get('content_plan', {}).get('topic', ''),
+            recipe.get('context_budget', DEFAULT_CONTEXT_BUDGET)
+        )
         
-        content_validation = validate_content(all_content, recipe, all_required_vars)
-        html_validation = validate_html(final_html)
-        
-        output = {
-            'subject': subject,
-            'preheader': preheader,
-            'fields': all_fields,
-            'html_content': final_html,
-            'content_validation': content_validation,
-            'html_validation': html_validation,
-            'mapping_log': mapping_log,
-            'recipe_used': content_type_code,
-            'recipe_version': RECIPE_VERSION,
-            'transform_version': TRANSFORM_VERSION,
-            'inputs_hash': inputs_hash
-        }
+        output = render_email(body_data, template, event_dict, ranked_knowledge, inputs_hash, progress=progress)
         
-        try:
-            validate(instance=output, schema=OUTPUT_SCHEMA)
-        except JSONValidationError as e:
-            output['output_schema_warning'] = f'Output validation failed: {e.message}'
+        store_cached_output(cur, cache_key, inputs_hash, template_id, event_id, output)
+        conn.commit()
+        output['cache'] = 'miss'
+        if progress:
+            progress.finish(output)
         
         return {
             'statusCode': 200,
@@ -646,6 +1570,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
         
     except Exception as e:
+        if 'progress' in locals() and progress:
+            progress.fail(str(e))
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -656,4 +1582,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if 'cur' in locals():
             cur.close()
         if 'conn' in locals():
-            conn.close()
+            release_db_connection(conn)
+        if 'progress' in locals() and progress:
+            progress.close()
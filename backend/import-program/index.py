@@ -1,21 +1,72 @@
 '''
 Business: Import program from Google Sheets to Knowledge Base
-Args: event with httpMethod, body containing event_id, sheets_url
+Args: event with httpMethod, body containing event_id, sheets_url, speakers/sections/talks, bulk
 Returns: HTTP response with import result (speakers, talks, sections count)
 '''
 
 import json
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any, List
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from typing import Dict, Any, List, Tuple, Optional
 import re
+import time
+
+SPEAKER_COLUMNS = ('event_id', 'speaker_id', 'name', 'title', 'company', 'topic', 'bio', 'photo', 'links')
+SECTION_COLUMNS = ('event_id', 'section_id', 'title', 'description', 'tags', 'day_id')
+TALK_COLUMNS = ('event_id', 'talk_id', 'title', 'speaker_id', 'start_time', 'end_time', 'abstract', 'keywords', 'section_id')
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
 def get_db_connection():
-    dsn = os.environ.get('DATABASE_URL')
-    if not dsn:
-        raise ValueError('DATABASE_URL not set')
-    return psycopg2.connect(dsn)
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
 
 def slugify(text: str) -> str:
     text = text.lower().strip()
@@ -23,13 +74,75 @@ def slugify(text: str) -> str:
     text = re.sub(r'[-\s]+', '-', text)
     return text
 
+def speaker_row(event_id: str, speaker: Dict[str, Any]) -> Tuple:
+    return (
+        event_id,
+        slugify(speaker.get('name', '')),
+        speaker.get('name', ''),
+        speaker.get('title', ''),
+        speaker.get('company', ''),
+        speaker.get('topic', ''),
+        speaker.get('bio', ''),
+        speaker.get('photo', ''),
+        json.dumps(speaker.get('links', {}))
+    )
+
+def section_row(event_id: str, section: Dict[str, Any]) -> Tuple:
+    return (
+        event_id,
+        slugify(section.get('title', '')),
+        section.get('title', ''),
+        section.get('description', ''),
+        json.dumps(section.get('tags', [])),
+        section.get('day_id', 'day1')
+    )
+
+def talk_row(event_id: str, talk: Dict[str, Any]) -> Tuple:
+    return (
+        event_id,
+        slugify(talk.get('title', '')),
+        talk.get('title', ''),
+        slugify(talk.get('speaker_name', '')),
+        talk.get('start_time', ''),
+        talk.get('end_time', ''),
+        talk.get('abstract', ''),
+        json.dumps(talk.get('keywords', [])),
+        slugify(talk.get('section_title', ''))
+    )
+
+def bulk_upsert(cur, table: str, columns: Tuple[str, ...], key_columns: Tuple[str, ...], rows: List[Tuple]) -> Dict[str, Any]:
+    '''One set-based upsert per table; unchanged rows are skipped by the IS DISTINCT FROM guard'''
+    started = time.monotonic()
+    key_size = len(key_columns)
+    rows = list({row[:key_size]: row for row in rows}.values())
+    update_columns = [c for c in columns if c not in key_columns]
+    
+    results = execute_values(
+        cur,
+        f"""INSERT INTO {table} AS t ({', '.join(columns)}) VALUES %s
+        ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET
+        {', '.join(f'{c} = EXCLUDED.{c}' for c in update_columns)}
+        WHERE ({', '.join(f't.{c}' for c in update_columns)}) IS DISTINCT FROM ({', '.join(f'EXCLUDED.{c}' for c in update_columns)})
+        RETURNING (xmax = 0) AS inserted""",
+        rows,
+        template=f"({', '.join(['%s'] * len(columns))})",
+        page_size=max(len(rows), 1),
+        fetch=True
+    )
+    inserted = sum(1 for (is_insert,) in results if is_insert)
+    
+    return {
+        'inserted': inserted,
+        'updated': len(results) - inserted,
+        'unchanged': len(rows) - len(results),
+        'ms': int((time.monotonic() - started) * 1000)
+    }
+
 def import_speakers(conn, event_id: str, speakers_data: List[Dict[str, Any]]) -> int:
     cur = conn.cursor()
     count = 0
     
     for speaker in speakers_data:
-        speaker_id = slugify(speaker.get('name', ''))
-        
         cur.execute(
             """INSERT INTO kb_speakers 
             (event_id, speaker_id, name, title, company, topic, bio, photo, links)
@@ -42,17 +155,7 @@ def import_speakers(conn, event_id: str, speakers_data: List[Dict[str, Any]]) ->
             bio = EXCLUDED.bio,
             photo = EXCLUDED.photo,
             links = EXCLUDED.links""",
-            (
-                event_id,
-                speaker_id,
-                speaker.get('name', ''),
-                speaker.get('title', ''),
-                speaker.get('company', ''),
-                speaker.get('topic', ''),
-                speaker.get('bio', ''),
-                speaker.get('photo', ''),
-                json.dumps(speaker.get('links', {}))
-            )
+            speaker_row(event_id, speaker)
         )
         count += 1
     
@@ -65,8 +168,6 @@ def import_sections(conn, event_id: str, sections_data: List[Dict[str, Any]]) ->
     count = 0
     
     for section in sections_data:
-        section_id = slugify(section.get('title', ''))
-        
         cur.execute(
             """INSERT INTO kb_sections 
             (event_id, section_id, title, description, tags, day_id)
@@ -76,14 +177,7 @@ def import_sections(conn, event_id: str, sections_data: List[Dict[str, Any]]) ->
             description = EXCLUDED.description,
             tags = EXCLUDED.tags,
             day_id = EXCLUDED.day_id""",
-            (
-                event_id,
-                section_id,
-                section.get('title', ''),
-                section.get('description', ''),
-                json.dumps(section.get('tags', [])),
-                section.get('day_id', 'day1')
-            )
+            section_row(event_id, section)
         )
         count += 1
     
@@ -96,10 +190,6 @@ def import_talks(conn, event_id: str, talks_data: List[Dict[str, Any]]) -> int:
     count = 0
     
     for talk in talks_data:
-        talk_id = slugify(talk.get('title', ''))
-        speaker_id = slugify(talk.get('speaker_name', ''))
-        section_id = slugify(talk.get('section_title', ''))
-        
         cur.execute(
             """INSERT INTO kb_talks 
             (event_id, talk_id, title, speaker_id, start_time, end_time, abstract, keywords, section_id)
@@ -112,17 +202,7 @@ def import_talks(conn, event_id: str, talks_data: List[Dict[str, Any]]) -> int:
             abstract = EXCLUDED.abstract,
             keywords = EXCLUDED.keywords,
             section_id = EXCLUDED.section_id""",
-            (
-                event_id,
-                talk_id,
-                talk.get('title', ''),
-                speaker_id,
-                talk.get('start_time', ''),
-                talk.get('end_time', ''),
-                talk.get('abstract', ''),
-                json.dumps(talk.get('keywords', [])),
-                section_id
-            )
+            talk_row(event_id, talk)
         )
         count += 1
     
@@ -130,6 +210,23 @@ def import_talks(conn, event_id: str, talks_data: List[Dict[str, Any]]) -> int:
     conn.commit()
     return count
 
+def upsert_program(cur, event_id: str, days: List[Dict[str, str]]) -> None:
+    cur.execute(
+        """INSERT INTO kb_program (event_id, days, sections, talks)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (event_id) DO UPDATE SET
+        days = EXCLUDED.days,
+        sections = EXCLUDED.sections,
+        talks = EXCLUDED.talks,
+        updated_at = CURRENT_TIMESTAMP""",
+        (
+            event_id,
+            json.dumps(days),
+            json.dumps([]),
+            json.dumps([])
+        )
+    )
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
     
@@ -173,6 +270,47 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
+        days = []
+        if talks_data:
+            unique_days = set()
+            for talk in talks_data:
+                day_id = talk.get('day_id', 'day1')
+                unique_days.add(day_id)
+            days = [{'id': day_id, 'label': f'День {i+1}'} for i, day_id in enumerate(sorted(unique_days))]
+        
+        if body_data.get('bulk'):
+            started = time.monotonic()
+            cur = conn.cursor()
+            stats = {}
+            if speakers_data:
+                stats['speakers'] = bulk_upsert(cur, 'kb_speakers', SPEAKER_COLUMNS, ('event_id', 'speaker_id'),
+                                                [speaker_row(event_id, speaker) for speaker in speakers_data])
+            if sections_data:
+                stats['sections'] = bulk_upsert(cur, 'kb_sections', SECTION_COLUMNS, ('event_id', 'section_id'),
+                                                [section_row(event_id, section) for section in sections_data])
+            if talks_data:
+                stats['talks'] = bulk_upsert(cur, 'kb_talks', TALK_COLUMNS, ('event_id', 'talk_id'),
+                                             [talk_row(event_id, talk) for talk in talks_data])
+            upsert_program(cur, event_id, days)
+            cur.close()
+            conn.commit()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'imported': {
+                        table: table_stats['inserted'] + table_stats['updated'] + table_stats['unchanged']
+                        for table, table_stats in stats.items()
+                    },
+                    'stats': stats,
+                    'elapsed_ms': int((time.monotonic() - started) * 1000),
+                    'sheets_url': sheets_url
+                }),
+                'isBase64Encoded': False
+            }
+        
         speakers_count = 0
         sections_count = 0
         talks_count = 0
@@ -186,30 +324,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if talks_data:
             talks_count = import_talks(conn, event_id, talks_data)
         
-        days = []
-        if talks_data:
-            unique_days = set()
-            for talk in talks_data:
-                day_id = talk.get('day_id', 'day1')
-                unique_days.add(day_id)
-            days = [{'id': day_id, 'label': f'День {i+1}'} for i, day_id in enumerate(sorted(unique_days))]
-        
         cur = conn.cursor()
-        cur.execute(
-            """INSERT INTO kb_program (event_id, days, sections, talks)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (event_id) DO UPDATE SET
-            days = EXCLUDED.days,
-            sections = EXCLUDED.sections,
-            talks = EXCLUDED.talks,
-            updated_at = CURRENT_TIMESTAMP""",
-            (
-                event_id,
-                json.dumps(days),
-                json.dumps([]),
-                json.dumps([])
-            )
-        )
+        upsert_program(cur, event_id, days)
         cur.close()
         conn.commit()
         
@@ -240,4 +356,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     finally:
-        conn.close()
+        release_db_connection(conn)
@@ -1,21 +1,351 @@
 '''
 Business: Generate email content using RAG (semantic search) and GPT-4
-Args: event - dict with event_id, prompt, content_type, max_length
+Args: event - dict with event_id, prompt, content_type, max_length, optional progress_id (poll GET ?progress_id= for partial text)
 Returns: HTTP response with generated text using relevant knowledge base chunks
 '''
 import json
 import os
-from typing import Dict, Any, List
+import time
+import hashlib
+import struct
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
 from openai import OpenAI
 import numpy as np
 import httpx
 
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    a = np.array(vec1)
-    b = np.array(vec2)
-    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+EMBEDDING_MODEL = 'text-embedding-3-small'
+
+def pack_embedding(values: List[float]) -> bytes:
+    return struct.pack(f'<{len(values)}f', *values)
+
+def unpack_embedding(data) -> List[float]:
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+EMBEDDING_LRU_SIZE = 1024
+_embedding_lru: OrderedDict = OrderedDict()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode()).hexdigest()
+
+def remember_embedding(model: str, digest: str, vector: List[float]) -> None:
+    _embedding_lru[(model, digest)] = vector
+    _embedding_lru.move_to_end((model, digest))
+    if len(_embedding_lru) > EMBEDDING_LRU_SIZE:
+        _embedding_lru.popitem(last=False)
+
+def get_embeddings(client, cur, model: str, texts: List[str]) -> Tuple[List[List[float]], Dict[str, int]]:
+    '''Resolve embeddings through in-process LRU, then embedding_cache table, then the embeddings API'''
+    stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+    vectors: List[Any] = [None] * len(texts)
+    unresolved: Dict[str, List[int]] = {}
+    
+    for i, text in enumerate(texts):
+        digest = text_hash(text)
+        cached = _embedding_lru.get((model, digest))
+        if cached is not None:
+            _embedding_lru.move_to_end((model, digest))
+            vectors[i] = cached
+            stats['memory_hits'] += 1
+        else:
+            unresolved.setdefault(digest, []).append(i)
+    
+    if unresolved:
+        cur.execute(
+            """SELECT text_hash, embedding_bin FROM t_p17985067_event_email_automati.embedding_cache
+            WHERE model = %s AND text_hash = ANY(%s)""",
+            (model, list(unresolved))
+        )
+        for digest, embedding_bin in cur.fetchall():
+            vector = unpack_embedding(embedding_bin)
+            remember_embedding(model, digest, vector)
+            for i in unresolved.pop(digest, []):
+                vectors[i] = vector
+                stats['db_hits'] += 1
+    
+    if unresolved:
+        digests = list(unresolved)
+        response = client.embeddings.create(
+            model=model,
+            input=[texts[unresolved[digest][0]] for digest in digests]
+        )
+        rows = []
+        for item in response.data:
+            digest = digests[item.index]
+            vector = item.embedding
+            remember_embedding(model, digest, vector)
+            for i in unresolved[digest]:
+                vectors[i] = vector
+                stats['misses'] += 1
+            rows.append((model, digest, psycopg2.Binary(pack_embedding(vector)), len(vector)))
+        
+        psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO t_p17985067_event_email_automati.embedding_cache
+            (model, text_hash, embedding_bin, embedding_dim) VALUES %s
+            ON CONFLICT DO NOTHING""",
+            rows
+        )
+    
+    return vectors, stats
+
+
+def decode_embedding(embedding_bin: Optional[memoryview], embedding_json: Any) -> np.ndarray:
+    '''Zero-copy view over little-endian float32 bytes, JSONB fallback for rows not yet backfilled'''
+    if embedding_bin is not None:
+        return np.frombuffer(embedding_bin, dtype='<f4')
+    if isinstance(embedding_json, str):
+        embedding_json = json.loads(embedding_json)
+    return np.asarray(embedding_json, dtype=np.float32)
+
+class VectorIndex:
+    '''Pre-normalized float32 matrix of event chunks: one matrix-vector product per query'''
+    def __init__(self, rows: List[tuple]):
+        self.ids: List[int] = []
+        self.content_types: List[str] = []
+        self.content_ids: List[Optional[str]] = []
+        self.texts: List[str] = []
+        self.metadata: List[Any] = []
+        vectors = []
+        for chunk_id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin, embedding_json in rows:
+            self.ids.append(chunk_id)
+            self.content_types.append(content_type)
+            self.content_ids.append(content_id)
+            self.texts.append(chunk_text)
+            self.metadata.append(chunk_metadata)
+            vectors.append(decode_embedding(embedding_bin, embedding_json))
+        
+        matrix = np.vstack(vectors).astype(np.float32, copy=False) if vectors else np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = matrix / norms
+        self.type_array = np.asarray(self.content_types, dtype=object)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def search(self, query_vector: List[float], top_k: int, content_types: Optional[List[str]] = None) -> List[Tuple[int, float]]:
+        if top_k <= 0 or not self.ids:
+            return []
+        
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+        
+        scores = self.matrix @ query
+        if content_types:
+            candidates = np.flatnonzero(np.isin(self.type_array, content_types))
+            scores = scores[candidates]
+        else:
+            candidates = np.arange(len(scores))
+        
+        k = min(top_k, len(candidates))
+        if k == 0:
+            return []
+        
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
+
+INDEX_CACHE_MAX_EVENTS = 8
+INDEX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# LRU by event_id, bounded by entry count and by the total size of the embedding matrices
+_index_cache: OrderedDict = OrderedDict()
+
+def remember_index(event_id: str, signature: tuple, index: VectorIndex) -> None:
+    _index_cache[event_id] = (signature, index)
+    _index_cache.move_to_end(event_id)
+    cached_bytes = sum(cached.matrix.nbytes for _, cached in _index_cache.values())
+    while len(_index_cache) > 1 and (len(_index_cache) > INDEX_CACHE_MAX_EVENTS or cached_bytes > INDEX_CACHE_MAX_BYTES):
+        _, (_, evicted) = _index_cache.popitem(last=False)
+        cached_bytes -= evicted.matrix.nbytes
+
+def load_event_index(cur, event_id: str) -> VectorIndex:
+    '''Return cached index for the event, rebuilding it only when its chunk set changed'''
+    cur.execute("""
+        SELECT COUNT(*), MAX(id), COUNT(embedding_bin)
+        FROM t_p17985067_event_email_automati.kb_embeddings
+        WHERE event_id = %s AND (embedding_bin IS NOT NULL OR embedding_vector IS NOT NULL)
+    """, (event_id,))
+    signature = tuple(cur.fetchone())
+    
+    cached = _index_cache.get(event_id)
+    if cached and cached[0] == signature:
+        _index_cache.move_to_end(event_id)
+        return cached[1]
+    
+    cur.execute("""
+        SELECT id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin,
+               CASE WHEN embedding_bin IS NULL THEN embedding_vector END
+        FROM t_p17985067_event_email_automati.kb_embeddings
+        WHERE event_id = %s AND (embedding_bin IS NOT NULL OR embedding_vector IS NOT NULL)
+        ORDER BY id
+    """, (event_id,))
+    index = VectorIndex(cur.fetchall())
+    remember_index(event_id, signature, index)
+    return index
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[OpenAI] = None
+
+def get_openai_client() -> OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    if _openai_client is None:
+        proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+        http_client = httpx.Client(
+            proxy=proxy_url or None,
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+        )
+        _openai_client = OpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            http_client=http_client,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+    return _openai_client
+
+PROGRESS_FLUSH_SECONDS = float(os.environ.get('PROGRESS_FLUSH_SECONDS', '0.3'))
+
+class ProgressWriter:
+    '''Generated text so far in generation_progress, committed on its own connection so GET ?progress_id= sees it
+    while the POST is still running (the runtime returns the HTTP response only as a whole)'''
+    def __init__(self, progress_id: str):
+        self.progress_id = progress_id
+        self.text = ''
+        self.flushed_at = 0.0
+        self.conn = get_db_connection()
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """INSERT INTO t_p17985067_event_email_automati.generation_progress (progress_id, source, status)
+                   VALUES (%s, 'rag-content-gen', 'running')
+                   ON CONFLICT (progress_id) DO UPDATE SET
+                       source = EXCLUDED.source, status = 'running', partial_text = '', fields = '{}'::jsonb,
+                       result = NULL, error = NULL, updated_at = CURRENT_TIMESTAMP""",
+                (progress_id,)
+            )
+    
+    def append(self, delta: str):
+        self.text += delta
+        if time.monotonic() - self.flushed_at >= PROGRESS_FLUSH_SECONDS:
+            self.flush()
+    
+    def flush(self, status: str = 'running', result: Optional[Dict] = None, error: Optional[str] = None):
+        with self.conn.cursor() as cur:
+            cur.execute(
+                """UPDATE t_p17985067_event_email_automati.generation_progress
+                   SET status = %s, partial_text = %s, result = %s::jsonb, error = %s, updated_at = CURRENT_TIMESTAMP
+                   WHERE progress_id = %s""",
+                (status, self.text, json.dumps(result) if result is not None else None, error, self.progress_id)
+            )
+        self.flushed_at = time.monotonic()
+    
+    def fail(self, error: str):
+        try:
+            self.flush('failed', error=error)
+        except psycopg2.Error:
+            pass
+    
+    def close(self):
+        release_db_connection(self.conn)
+
+def handle_progress_status(progress_id: str) -> Dict[str, Any]:
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            "SELECT * FROM t_p17985067_event_email_automati.generation_progress WHERE progress_id = %s",
+            (progress_id,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        release_db_connection(conn)
+    
+    if not row:
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Progress not found'})
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Cache-Control': 'no-store'},
+        'body': json.dumps(dict(row), default=str, ensure_ascii=False)
+    }
+
+def generate_text(client, messages: List[Dict[str, str]], progress: Optional[ProgressWriter]) -> str:
+    params = {'model': 'gpt-4o-mini', 'messages': messages, 'temperature': 0.7, 'max_tokens': 800}
+    if progress is None:
+        completion = client.chat.completions.create(**params)
+        return completion.choices[0].message.content.strip()
+    
+    # Same completion streamed, so the progress row fills while the model is still writing
+    for chunk in client.chat.completions.create(stream=True, **params):
+        if chunk.choices and chunk.choices[0].delta.content:
+            progress.append(chunk.choices[0].delta.content)
+    return progress.text.strip()
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -25,13 +355,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
+    if method == 'GET':
+        progress_id = (event.get('queryStringParameters') or {}).get('progress_id')
+        if not progress_id:
+            return {
+                'statusCode': 400,
+                'headers': {'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'progress_id is required'})
+            }
+        return handle_progress_status(progress_id)
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -45,6 +385,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     content_types: List[str] = body_data.get('content_types', [])
     max_length: int = body_data.get('max_length', 500)
     top_k: int = body_data.get('top_k', 5)
+    progress_id: Optional[str] = body_data.get('progress_id')
     
     if not event_id or not prompt:
         return {
@@ -53,66 +394,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'event_id and prompt required'})
         }
     
-    # Initialize OpenAI client with proxy support
-    api_key = os.environ.get('OPENAI_API_KEY')
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
-    
-    if proxy_url:
-        http_client = httpx.Client(proxies=proxy_url)
-        client = OpenAI(api_key=api_key, http_client=http_client)
-    else:
-        client = OpenAI(api_key=api_key)
-    
-    # Generate embedding for search query
-    query_response = client.embeddings.create(
-        model='text-embedding-3-small',
-        input=[prompt]
-    )
-    query_embedding = query_response.data[0].embedding
-    
-    # Search in vector database
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    
-    sql = '''
-        SELECT id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector
-        FROM t_p17985067_event_email_automati.kb_embeddings
-        WHERE event_id = %s AND embedding_vector IS NOT NULL
-    '''
-    params = [event_id]
+    client = get_openai_client()
     
-    if content_types:
-        placeholders = ','.join(['%s'] * len(content_types))
-        sql += f' AND content_type IN ({placeholders})'
-        params.extend(content_types)
+    # Generate embedding for search query and search in vector database
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        embeddings, cache_stats = get_embeddings(client, cur, EMBEDDING_MODEL, [prompt])
+        query_embedding = embeddings[0]
+        conn.commit()
+        index = load_event_index(cur, event_id)
+        cur.close()
+    finally:
+        release_db_connection(conn)
     
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    top_chunks = [
+        {
+            'text': index.texts[i],
+            'similarity': similarity,
+            'metadata': index.metadata[i]
+        }
+        for i, similarity in index.search(query_embedding, top_k, content_types)
+    ]
     
-    if not rows:
+    if not top_chunks:
         return {
             'statusCode': 400,
             'headers': {'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'No embeddings found. Run vectorization first.'})
         }
     
-    # Calculate similarities and get top-k
-    results = []
-    for row in rows:
-        doc_embedding = json.loads(row['embedding_vector'])
-        similarity = cosine_similarity(query_embedding, doc_embedding)
-        results.append({
-            'text': row['chunk_text'],
-            'similarity': similarity,
-            'metadata': row['chunk_metadata']
-        })
-    
-    results.sort(key=lambda x: x['similarity'], reverse=True)
-    top_chunks = results[:top_k]
-    
     # Build context from top chunks
     context = '\n\n'.join([f"[{i+1}] {chunk['text']}" for i, chunk in enumerate(top_chunks)])
     
@@ -129,17 +440,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 Контекст из базы знаний:
 {context}'''
     
-    completion = client.chat.completions.create(
-        model='gpt-4o-mini',
-        messages=[
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': prompt}
-        ],
-        temperature=0.7,
-        max_tokens=800
-    )
+    messages = [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': prompt}
+    ]
+    sources = [
+        {
+            'text': chunk['text'][:150] + '...',
+            'similarity': chunk['similarity']
+        }
+        for chunk in top_chunks[:3]
+    ]
     
-    generated_text = completion.choices[0].message.content.strip()
+    progress = ProgressWriter(progress_id) if progress_id else None
+    try:
+        generated_text = generate_text(client, messages, progress)
+        if progress:
+            # Terminal event: the full text with the same length check the prompt asks the model for
+            progress.flush('done', {
+                'generated_text': generated_text,
+                'length': len(generated_text),
+                'max_length': max_length,
+                'within_max_length': len(generated_text) <= max_length
+            })
+    except Exception as e:
+        if progress:
+            progress.fail(str(e))
+        raise
+    finally:
+        if progress:
+            progress.close()
     
     return {
         'statusCode': 200,
@@ -150,12 +480,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({
             'generated_text': generated_text,
             'sources_used': len(top_chunks),
-            'sources': [
-                {
-                    'text': chunk['text'][:150] + '...',
-                    'similarity': chunk['similarity']
-                }
-                for chunk in top_chunks[:3]
-            ]
+            'embedding_cache': cache_stats,
+            'sources': sources
         })
     }
\ No newline at end of file
@@ -5,10 +5,165 @@ Returns: HTTP response with generated embedding IDs
 '''
 import json
 import os
-from typing import Dict, Any, List
+import time
+import hashlib
+import struct
+from collections import OrderedDict
+from typing import Dict, Any, List, Tuple, Optional
 import psycopg2
 import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
 from openai import OpenAI
+import httpx
+
+EMBEDDING_MODEL = 'text-embedding-3-small'
+
+def pack_embedding(values: List[float]) -> bytes:
+    return struct.pack(f'<{len(values)}f', *values)
+
+def unpack_embedding(data) -> List[float]:
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+EMBEDDING_LRU_SIZE = 1024
+_embedding_lru: OrderedDict = OrderedDict()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode()).hexdigest()
+
+def remember_embedding(model: str, digest: str, vector: List[float]) -> None:
+    _embedding_lru[(model, digest)] = vector
+    _embedding_lru.move_to_end((model, digest))
+    if len(_embedding_lru) > EMBEDDING_LRU_SIZE:
+        _embedding_lru.popitem(last=False)
+
+def get_embeddings(client, cur, model: str, texts: List[str]) -> Tuple[List[List[float]], Dict[str, int]]:
+    '''Resolve embeddings through in-process LRU, then embedding_cache table, then the embeddings API'''
+    stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+    vectors: List[Any] = [None] * len(texts)
+    unresolved: Dict[str, List[int]] = {}
+    
+    for i, text in enumerate(texts):
+        digest = text_hash(text)
+        cached = _embedding_lru.get((model, digest))
+        if cached is not None:
+            _embedding_lru.move_to_end((model, digest))
+            vectors[i] = cached
+            stats['memory_hits'] += 1
+        else:
+            unresolved.setdefault(digest, []).append(i)
+    
+    if unresolved:
+        cur.execute(
+            """SELECT text_hash, embedding_bin FROM t_p17985067_event_email_automati.embedding_cache
+            WHERE model = %s AND text_hash = ANY(%s)""",
+            (model, list(unresolved))
+        )
+        for digest, embedding_bin in cur.fetchall():
+            vector = unpack_embedding(embedding_bin)
+            remember_embedding(model, digest, vector)
+            for i in unresolved.pop(digest, []):
+                vectors[i] = vector
+                stats['db_hits'] += 1
+    
+    if unresolved:
+        digests = list(unresolved)
+        response = client.embeddings.create(
+            model=model,
+            input=[texts[unresolved[digest][0]] for digest in digests]
+        )
+        rows = []
+        for item in response.data:
+            digest = digests[item.index]
+            vector = item.embedding
+            remember_embedding(model, digest, vector)
+            for i in unresolved[digest]:
+                vectors[i] = vector
+                stats['misses'] += 1
+            rows.append((model, digest, psycopg2.Binary(pack_embedding(vector)), len(vector)))
+        
+        psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO t_p17985067_event_email_automati.embedding_cache
+            (model, text_hash, embedding_bin, embedding_dim) VALUES %s
+            ON CONFLICT DO NOTHING""",
+            rows
+        )
+    
+    return vectors, stats
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[OpenAI] = None
+
+def get_openai_client() -> OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    if _openai_client is None:
+        proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+        http_client = httpx.Client(
+            proxy=proxy_url or None,
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+        )
+        _openai_client = OpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            http_client=http_client,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+    return _openai_client
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -44,49 +199,41 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'event_id and chunks required'})
         }
     
-    # Initialize OpenAI client
-    api_key = os.environ.get('OPENAI_API_KEY')
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
-    if proxy_url:
-        client = OpenAI(api_key=api_key, base_url=proxy_url)
-    else:
-        client = OpenAI(api_key=api_key)
-    
-    # Generate embeddings for all chunks
-    texts = [chunk['text'] for chunk in chunks]
-    response = client.embeddings.create(
-        model='text-embedding-3-small',
-        input=texts
-    )
-    
-    embeddings = [item.embedding for item in response.data]
+    client = get_openai_client()
     
     # Connect to database
-    dsn = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    inserted_ids = []
-    
-    for chunk, embedding in zip(chunks, embeddings):
-        cur.execute('''
-            INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
-            (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (
-            event_id,
-            chunk.get('content_type', 'text'),
-            chunk.get('content_id'),
-            chunk['text'],
-            json.dumps(chunk.get('metadata', {})),
-            json.dumps(embedding)
-        ))
-        inserted_ids.append(cur.fetchone()[0])
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        
+        # Generate embeddings for all chunks
+        texts = [chunk['text'] for chunk in chunks]
+        embeddings, cache_stats = get_embeddings(client, cur, EMBEDDING_MODEL, texts)
+        
+        inserted_ids = []
+        
+        for chunk, embedding in zip(chunks, embeddings):
+            cur.execute('''
+                INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
+                (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin, embedding_dim, embedding_model)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (
+                event_id,
+                chunk.get('content_type', 'text'),
+                chunk.get('content_id'),
+                chunk['text'],
+                json.dumps(chunk.get('metadata', {})),
+                psycopg2.Binary(pack_embedding(embedding)),
+                len(embedding),
+                EMBEDDING_MODEL
+            ))
+            inserted_ids.append(cur.fetchone()[0])
+        
+        conn.commit()
+        cur.close()
+    finally:
+        release_db_connection(conn)
     
     return {
         'statusCode': 200,
@@ -96,6 +243,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         },
         'body': json.dumps({
             'inserted_count': len(inserted_ids),
+            'embedding_cache': cache_stats,
             'ids': inserted_ids
         })
     }
\ No newline at end of file
@@ -1,21 +1,268 @@
 import json
 import os
+import time
+import hashlib
+import struct
+from collections import OrderedDict
 import psycopg2
+import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
 import openai
 import httpx
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 import numpy as np
 
-def cosine_similarity(a: List[float], b: List[float]) -> float:
-    '''Calculate cosine similarity between two vectors'''
-    a_arr = np.array(a)
-    b_arr = np.array(b)
-    return np.dot(a_arr, b_arr) / (np.linalg.norm(a_arr) * np.linalg.norm(b_arr))
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+def pack_embedding(values: List[float]) -> bytes:
+    return struct.pack(f'<{len(values)}f', *values)
+
+def unpack_embedding(data) -> List[float]:
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+EMBEDDING_LRU_SIZE = 1024
+_embedding_lru: OrderedDict = OrderedDict()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode()).hexdigest()
+
+def remember_embedding(model: str, digest: str, vector: List[float]) -> None:
+    _embedding_lru[(model, digest)] = vector
+    _embedding_lru.move_to_end((model, digest))
+    if len(_embedding_lru) > EMBEDDING_LRU_SIZE:
+        _embedding_lru.popitem(last=False)
+
+def get_embeddings(client, cur, model: str, texts: List[str]) -> Tuple[List[List[float]], Dict[str, int]]:
+    '''Resolve embeddings through in-process LRU, then embedding_cache table, then the embeddings API'''
+    stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+    vectors: List[Any] = [None] * len(texts)
+    unresolved: Dict[str, List[int]] = {}
+    
+    for i, text in enumerate(texts):
+        digest = text_hash(text)
+        cached = _embedding_lru.get((model, digest))
+        if cached is not None:
+            _embedding_lru.move_to_end((model, digest))
+            vectors[i] = cached
+            stats['memory_hits'] += 1
+        else:
+            unresolved.setdefault(digest, []).append(i)
+    
+    if unresolved:
+        cur.execute(
+            """SELECT text_hash, embedding_bin FROM t_p17985067_event_email_automati.embedding_cache
+            WHERE model = %s AND text_hash = ANY(%s)""",
+            (model, list(unresolved))
+        )
+        for digest, embedding_bin in cur.fetchall():
+            vector = unpack_embedding(embedding_bin)
+            remember_embedding(model, digest, vector)
+            for i in unresolved.pop(digest, []):
+                vectors[i] = vector
+                stats['db_hits'] += 1
+    
+    if unresolved:
+        digests = list(unresolved)
+        response = client.embeddings.create(
+            model=model,
+            input=[texts[unresolved[digest][0]] for digest in digests]
+        )
+        rows = []
+        for item in response.data:
+            digest = digests[item.index]
+            vector = item.embedding
+            remember_embedding(model, digest, vector)
+            for i in unresolved[digest]:
+                vectors[i] = vector
+                stats['misses'] += 1
+            rows.append((model, digest, psycopg2.Binary(pack_embedding(vector)), len(vector)))
+        
+        psycopg2.extras.execute_values(
+            cur,
+            """INSERT INTO t_p17985067_event_email_automati.embedding_cache
+            (model, text_hash, embedding_bin, embedding_dim) VALUES %s
+            ON CONFLICT DO NOTHING""",
+            rows
+        )
+    
+    return vectors, stats
+
+
+def decode_embedding(embedding_bin: Optional[memoryview], embedding_json: Any) -> np.ndarray:
+    '''Zero-copy view over little-endian float32 bytes, JSONB fallback for rows not yet backfilled'''
+    if embedding_bin is not None:
+        return np.frombuffer(embedding_bin, dtype='<f4')
+    if isinstance(embedding_json, str):
+        embedding_json = json.loads(embedding_json)
+    return np.asarray(embedding_json, dtype=np.float32)
+
+class VectorIndex:
+    '''Pre-normalized float32 matrix of event chunks: one matrix-vector product per query'''
+    def __init__(self, rows: List[tuple]):
+        self.ids: List[int] = []
+        self.content_types: List[str] = []
+        self.content_ids: List[Optional[str]] = []
+        self.texts: List[str] = []
+        self.metadata: List[Any] = []
+        vectors = []
+        for chunk_id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin, embedding_json in rows:
+            self.ids.append(chunk_id)
+            self.content_types.append(content_type)
+            self.content_ids.append(content_id)
+            self.texts.append(chunk_text)
+            self.metadata.append(chunk_metadata)
+            vectors.append(decode_embedding(embedding_bin, embedding_json))
+        
+        matrix = np.vstack(vectors).astype(np.float32, copy=False) if vectors else np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = matrix / norms
+        self.type_array = np.asarray(self.content_types, dtype=object)
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def search(self, query_vector: List[float], top_k: int, content_types: Optional[List[str]] = None) -> List[Tuple[int, float]]:
+        if top_k <= 0 or not self.ids:
+            return []
+        
+        query = np.asarray(query_vector, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm:
+            query = query / query_norm
+        
+        scores = self.matrix @ query
+        if content_types:
+            candidates = np.flatnonzero(np.isin(self.type_array, content_types))
+            scores = scores[candidates]
+        else:
+            candidates = np.arange(len(scores))
+        
+        k = min(top_k, len(candidates))
+        if k == 0:
+            return []
+        
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
+
+INDEX_CACHE_MAX_EVENTS = 8
+INDEX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# LRU by event_id, bounded by entry count and by the total size of the embedding matrices
+_index_cache: OrderedDict = OrderedDict()
+
+def remember_index(event_id: str, signature: tuple, index: VectorIndex) -> None:
+    _index_cache[event_id] = (signature, index)
+    _index_cache.move_to_end(event_id)
+    cached_bytes = sum(cached.matrix.nbytes for _, cached in _index_cache.values())
+    while len(_index_cache) > 1 and (len(_index_cache) > INDEX_CACHE_MAX_EVENTS or cached_bytes > INDEX_CACHE_MAX_BYTES):
+        _, (_, evicted) = _index_cache.popitem(last=False)
+        cached_bytes -= evicted.matrix.nbytes
+
+def load_event_index(cur, event_id: str) -> VectorIndex:
+    '''Return cached index for the event, rebuilding it only when its chunk set changed'''
+    cur.execute("""
+        SELECT COUNT(*), MAX(id), COUNT(embedding_bin)
+        FROM t_p17985067_event_email_automati.kb_embeddings
+        WHERE event_id = %s AND (embedding_bin IS NOT NULL OR embedding_vector IS NOT NULL)
+    """, (event_id,))
+    signature = tuple(cur.fetchone())
+    
+    cached = _index_cache.get(event_id)
+    if cached and cached[0] == signature:
+        _index_cache.move_to_end(event_id)
+        return cached[1]
+    
+    cur.execute("""
+        SELECT id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin,
+               CASE WHEN embedding_bin IS NULL THEN embedding_vector END
+        FROM t_p17985067_event_email_automati.kb_embeddings
+        WHERE event_id = %s AND (embedding_bin IS NOT NULL OR embedding_vector IS NOT NULL)
+        ORDER BY id
+    """, (event_id,))
+    index = VectorIndex(cur.fetchall())
+    remember_index(event_id, signature, index)
+    return index
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[openai.OpenAI] = None
+
+def get_openai_client() -> openai.OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    if _openai_client is None:
+        proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+        http_client = httpx.Client(
+            proxy=proxy_url or None,
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+        )
+        _openai_client = openai.OpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            http_client=http_client,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+    return _openai_client
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Semantic search in knowledge base using RAG
-    Args: event with httpMethod, queryStringParameters {event_id, query, limit}
+    Args: event with httpMethod, queryStringParameters {event_id, query, limit, content_types}
     Returns: HTTP response with relevant knowledge base chunks
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -43,6 +290,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     event_id: str = params.get('event_id')
     query: str = params.get('query')
     limit: int = int(params.get('limit', '5'))
+    content_types: List[str] = [t for t in (params.get('content_types') or '').split(',') if t]
     
     if not event_id or not query:
         return {
@@ -53,7 +301,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     dsn = os.environ.get('DATABASE_URL')
     openai_key = os.environ.get('OPENAI_API_KEY')
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
     
     if not dsn or not openai_key:
         return {
@@ -62,56 +309,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Missing DATABASE_URL or OPENAI_API_KEY'})
         }
     
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    client = get_openai_client()
     
-    if proxy_url:
-        http_client = httpx.Client(
-            proxies={
-                'http://': proxy_url,
-                'https://': proxy_url
-            }
-        )
-        client = openai.OpenAI(
-            api_key=openai_key,
-            http_client=http_client
-        )
-    else:
-        client = openai.OpenAI(api_key=openai_key)
+    conn = get_db_connection()
+    cur = conn.cursor()
     
     try:
-        response = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=query
-        )
-        query_embedding = response.data[0].embedding
-        
-        cur.execute("""
-            SELECT id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector
-            FROM t_p17985067_event_email_automati.kb_embeddings
-            WHERE event_id = %s AND embedding_vector IS NOT NULL
-        """, (event_id,))
+        embeddings, cache_stats = get_embeddings(client, cur, EMBEDDING_MODEL, [query])
+        query_embedding = embeddings[0]
+        conn.commit()
         
-        rows = cur.fetchall()
+        index = load_event_index(cur, event_id)
         
-        results = []
-        for row in rows:
-            chunk_id, content_type, content_id, chunk_text, chunk_metadata, embedding_str = row
-            
-            chunk_embedding = json.loads(embedding_str)
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-            
-            results.append({
-                'id': chunk_id,
-                'content_type': content_type,
-                'content_id': content_id,
-                'text': chunk_text,
-                'metadata': chunk_metadata,
-                'similarity': float(similarity)
-            })
-        
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        top_results = results[:limit]
+        top_results = [
+            {
+                'id': index.ids[i],
+                'content_type': index.content_types[i],
+                'content_id': index.content_ids[i],
+                'text': index.texts[i],
+                'metadata': index.metadata[i],
+                'similarity': similarity
+            }
+            for i, similarity in index.search(query_embedding, limit, content_types)
+        ]
         
         return {
             'statusCode': 200,
@@ -119,7 +339,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({
                 'status': 'success',
                 'query': query,
-                'results': top_results
+                'results': top_results,
+                'embedding_cache': cache_stats
             })
         }
         
@@ -131,4 +352,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
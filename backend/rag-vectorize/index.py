@@ -1,14 +1,347 @@
 '''
 Business: Vectorize knowledge base content using OpenAI embeddings
-Args: event with httpMethod, body {event_id, force_refresh}
+Args: event with httpMethod, body {event_id, force_refresh} or {action: 'backfill_binary', batch_size}
 Returns: HTTP response with vectorization status
 '''
 import json
 import os
+import hashlib
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 import openai
 import httpx
-from typing import Dict, Any
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_BATCH_TOKENS = 100000
+VECTORIZED_TYPES = ('speaker', 'talk', 'pain_point', 'benefit')
+EMBEDDING_LRU_SIZE = 1024
+
+_embedding_lru: OrderedDict = OrderedDict()
+
+def escape_sql(value):
+    if value is None:
+        return 'NULL'
+    return "'" + str(value).replace("'", "''") + "'"
+
+def pack_embedding(values: List[float]) -> bytes:
+    return struct.pack(f'<{len(values)}f', *values)
+
+def unpack_embedding(data) -> List[float]:
+    return list(struct.unpack(f'<{len(data) // 4}f', data))
+
+def escape_bytea(data: bytes) -> str:
+    return f"decode('{data.hex()}', 'hex')"
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(' '.join(text.split()).encode()).hexdigest()
+
+def remember_embedding(digest: str, vector: List[float]) -> None:
+    _embedding_lru[(EMBEDDING_MODEL, digest)] = vector
+    _embedding_lru.move_to_end((EMBEDDING_MODEL, digest))
+    if len(_embedding_lru) > EMBEDDING_LRU_SIZE:
+        _embedding_lru.popitem(last=False)
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(f'{EMBEDDING_MODEL}\n{text}'.encode()).hexdigest()
+
+def estimate_tokens(text: str) -> int:
+    # Cyrillic averages about 2 characters per token, keep the estimate conservative
+    return len(text) // 2 + 1
+
+def collect_chunks(cur, safe_event_id: str) -> List[Dict[str, Any]]:
+    chunks = []
+    
+    # Спикеры
+    cur.execute(f"""
+        SELECT speaker_id, name, title, company, topic, bio 
+        FROM t_p17985067_event_email_automati.kb_speakers 
+        WHERE event_id = {safe_event_id}
+    """)
+    for speaker_id, name, title, company, topic, bio in cur.fetchall():
+        chunks.append({
+            'content_type': 'speaker',
+            'content_id': speaker_id,
+            'text': f"Спикер: {name}. {title or ''} в {company or ''}. Тема доклада: {topic or ''}. Био: {bio or ''}",
+            'metadata': {'name': name, 'company': company}
+        })
+    
+    # Доклады
+    cur.execute(f"""
+        SELECT talk_id, title, abstract, speaker_id
+        FROM t_p17985067_event_email_automati.kb_talks 
+        WHERE event_id = {safe_event_id}
+    """)
+    for talk_id, title, abstract, speaker_id in cur.fetchall():
+        chunks.append({
+            'content_type': 'talk',
+            'content_id': talk_id,
+            'text': f"Доклад: {title or ''}. Описание: {abstract or ''}",
+            'metadata': {'title': title, 'speaker_id': speaker_id}
+        })
+    
+    # Боли аудитории
+    cur.execute(f"""
+        SELECT pain_point FROM t_p17985067_event_email_automati.kb_content 
+        WHERE event_id = {safe_event_id} AND pain_point IS NOT NULL
+    """)
+    for idx, (pain_point,) in enumerate(cur.fetchall()):
+        if pain_point and pain_point.strip():
+            chunks.append({'content_type': 'pain_point', 'content_id': f'pain_{idx}', 'text': pain_point, 'metadata': {}})
+    
+    # Выгоды и ценность
+    cur.execute(f"""
+        SELECT benefit FROM t_p17985067_event_email_automati.kb_content 
+        WHERE event_id = {safe_event_id} AND benefit IS NOT NULL
+    """)
+    for idx, (benefit,) in enumerate(cur.fetchall()):
+        if benefit and benefit.strip():
+            chunks.append({'content_type': 'benefit', 'content_id': f'benefit_{idx}', 'text': benefit, 'metadata': {}})
+    
+    for chunk in chunks:
+        chunk['content_hash'] = content_hash(chunk['text'])
+    return chunks
+
+def diff_chunks(cur, safe_event_id: str, chunks: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int], List[int]]:
+    '''Split chunks into pending (new or changed text), stale row ids to replace and orphaned row ids to drop'''
+    types_sql = ', '.join(escape_sql(t) for t in VECTORIZED_TYPES)
+    cur.execute(f"""
+        SELECT id, content_type, content_id, content_hash
+        FROM t_p17985067_event_email_automati.kb_embeddings
+        WHERE event_id = {safe_event_id} AND content_type IN ({types_sql})
+    """)
+    existing: Dict[Tuple[str, str], Tuple[int, Optional[str]]] = {}
+    orphan_ids: List[int] = []
+    for row_id, content_type, content_id, row_hash in cur.fetchall():
+        key = (content_type, content_id)
+        if key in existing:
+            orphan_ids.append(row_id)
+        else:
+            existing[key] = (row_id, row_hash)
+    
+    pending = []
+    stale_ids = []
+    for chunk in chunks:
+        row = existing.pop((chunk['content_type'], chunk['content_id']), None)
+        if row is None:
+            pending.append(chunk)
+        elif row[1] != chunk['content_hash']:
+            stale_ids.append(row[0])
+            pending.append(chunk)
+    
+    orphan_ids.extend(row_id for row_id, _ in existing.values())
+    return pending, stale_ids, orphan_ids
+
+def make_batches(chunks: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    batches = []
+    current = []
+    current_tokens = 0
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk['text'])
+        if current and (len(current) >= EMBEDDING_BATCH_SIZE or current_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(chunk)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def resolve_cached_embeddings(cur, chunks: List[Dict[str, Any]], stats: Dict[str, int]) -> List[Dict[str, Any]]:
+    '''Fill chunk embeddings from in-process LRU and embedding_cache table, return chunks still to embed'''
+    db_lookup: Dict[str, List[Dict[str, Any]]] = {}
+    for chunk in chunks:
+        digest = text_hash(chunk['text'])
+        chunk['text_hash'] = digest
+        cached = _embedding_lru.get((EMBEDDING_MODEL, digest))
+        if cached is not None:
+            _embedding_lru.move_to_end((EMBEDDING_MODEL, digest))
+            chunk['embedding'] = cached
+            stats['memory_hits'] += 1
+        else:
+            db_lookup.setdefault(digest, []).append(chunk)
+    
+    if db_lookup:
+        cur.execute(f"""
+            SELECT text_hash, embedding_bin FROM t_p17985067_event_email_automati.embedding_cache
+            WHERE model = {escape_sql(EMBEDDING_MODEL)} AND text_hash IN ({', '.join(escape_sql(d) for d in db_lookup)})
+        """)
+        for digest, embedding_bin in cur.fetchall():
+            vector = unpack_embedding(embedding_bin)
+            remember_embedding(digest, vector)
+            for chunk in db_lookup.pop(digest, []):
+                chunk['embedding'] = vector
+                stats['db_hits'] += 1
+    
+    return [chunk for group in db_lookup.values() for chunk in group]
+
+def embed_chunks(client, cur, chunks: List[Dict[str, Any]]) -> Dict[str, int]:
+    stats = {'batches': 0, 'tokens': 0, 'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+    unresolved = resolve_cached_embeddings(cur, chunks, stats)
+    
+    for batch in make_batches(unresolved):
+        response = client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[chunk['text'] for chunk in batch]
+        )
+        for item in response.data:
+            batch[item.index]['embedding'] = item.embedding
+            remember_embedding(batch[item.index]['text_hash'], item.embedding)
+        stats['batches'] += 1
+        stats['tokens'] += response.usage.total_tokens if response.usage else 0
+        stats['misses'] += len(batch)
+        
+        safe_model = escape_sql(EMBEDDING_MODEL)
+        values_sql = ', '.join(
+            f"({safe_model}, {escape_sql(chunk['text_hash'])}, "
+            f"{escape_bytea(pack_embedding(chunk['embedding']))}, {len(chunk['embedding'])})"
+            for chunk in batch
+        )
+        cur.execute(f"""
+            INSERT INTO t_p17985067_event_email_automati.embedding_cache 
+            (model, text_hash, embedding_bin, embedding_dim)
+            VALUES {values_sql}
+            ON CONFLICT DO NOTHING
+        """)
+    
+    return stats
+
+def write_chunks(cur, safe_event_id: str, chunks: List[Dict[str, Any]], delete_ids: List[int]) -> None:
+    '''Drop replaced/orphaned rows and insert new ones in a single statement batch (one implicit transaction)'''
+    statements = []
+    if delete_ids:
+        statements.append(f"""
+            DELETE FROM t_p17985067_event_email_automati.kb_embeddings
+            WHERE id IN ({', '.join(str(int(row_id)) for row_id in delete_ids)})
+        """)
+    
+    if chunks:
+        safe_model = escape_sql(EMBEDDING_MODEL)
+        values_sql = ', '.join(
+            f"({safe_event_id}, {escape_sql(chunk['content_type'])}, {escape_sql(chunk['content_id'])}, "
+            f"{escape_sql(chunk['text'])}, {escape_sql(json.dumps(chunk['metadata']))}, "
+            f"{escape_bytea(pack_embedding(chunk['embedding']))}, {len(chunk['embedding'])}, {safe_model}, "
+            f"{escape_sql(chunk['content_hash'])})"
+            for chunk in chunks
+        )
+        statements.append(f"""
+            INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
+            (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_bin, embedding_dim, embedding_model, content_hash)
+            VALUES {values_sql}
+        """)
+    
+    if statements:
+        cur.execute(';'.join(statements))
+
+def backfill_binary(cur, batch_size: int) -> Dict[str, int]:
+    '''Convert legacy JSONB vectors into embedding_bin and release the JSONB copy'''
+    converted = 0
+    batches = 0
+    while True:
+        cur.execute(f"""
+            SELECT id, embedding_vector FROM t_p17985067_event_email_automati.kb_embeddings
+            WHERE embedding_bin IS NULL AND embedding_vector IS NOT NULL
+            ORDER BY id LIMIT {int(batch_size)}
+        """)
+        rows = cur.fetchall()
+        if not rows:
+            break
+        
+        values_sql = []
+        for row_id, vector in rows:
+            if isinstance(vector, str):
+                vector = json.loads(vector)
+            values_sql.append(f"({int(row_id)}, {escape_bytea(pack_embedding(vector))}, {len(vector)})")
+        
+        cur.execute(f"""
+            UPDATE t_p17985067_event_email_automati.kb_embeddings AS e
+            SET embedding_bin = v.bin, embedding_dim = v.dim, embedding_vector = NULL
+            FROM (VALUES {', '.join(values_sql)}) AS v(id, bin, dim)
+            WHERE e.id = v.id
+        """)
+        converted += len(rows)
+        batches += 1
+    
+    return {'converted': converted, 'batches': batches}
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_HEALTHCHECK_IDLE = 30
+
+_db_pool: Optional[ThreadedConnectionPool] = None
+_db_last_used: Dict[int, float] = {}
+
+def get_db_pool() -> ThreadedConnectionPool:
+    global _db_pool
+    if _db_pool is None or _db_pool.closed:
+        _db_pool = ThreadedConnectionPool(1, DB_POOL_MAX, os.environ['DATABASE_URL'])
+        _db_last_used.clear()
+    return _db_pool
+
+def connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def get_db_connection():
+    '''Borrow a connection from the warm pool, replacing sockets that died while idle (server restart, timeouts)'''
+    pool = get_db_pool()
+    conn = pool.getconn()
+    while not connection_alive(conn):
+        _db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+def release_db_connection(conn) -> None:
+    broken = bool(conn.closed)
+    if not broken:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    get_db_pool().putconn(conn, close=broken)
+
+OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT', '60'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '3'))
+
+_openai_client: Optional[openai.OpenAI] = None
+
+def get_openai_client() -> openai.OpenAI:
+    '''Lazily built client kept across warm invocations: keep-alive HTTP/2 pool, SDK retries with backoff'''
+    global _openai_client
+    if _openai_client is None:
+        proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
+        http_client = httpx.Client(
+            proxy=proxy_url or None,
+            http2=True,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=300)
+        )
+        _openai_client = openai.OpenAI(
+            api_key=os.environ['OPENAI_API_KEY'],
+            http_client=http_client,
+            max_retries=OPENAI_MAX_RETRIES
+        )
+    return _openai_client
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -35,6 +368,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     body_data = json.loads(event.get('body', '{}'))
+    
+    if body_data.get('action') == 'backfill_binary':
+        conn = get_db_connection()
+        conn.set_session(autocommit=True)
+        cur = conn.cursor()
+        try:
+            stats = backfill_binary(cur, body_data.get('batch_size', 500))
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'status': 'success', **stats}),
+            'isBase64Encoded': False
+        }
+    
     event_id: str = body_data.get('event_id')
     force_refresh: bool = body_data.get('force_refresh', False)
     
@@ -46,192 +396,46 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    dsn = os.environ['DATABASE_URL']
-    
-    # Initialize OpenAI client (same way as generate-email)
-    proxy_url = os.environ.get('OPENAI_PROXY_URL', '').strip()
-    
-    if proxy_url:
-        http_client = httpx.Client(
-            proxies={
-                'http://': proxy_url,
-                'https://': proxy_url
-            }
-        )
-        client = openai.OpenAI(
-            api_key=os.environ['OPENAI_API_KEY'],
-            http_client=http_client
-        )
-    else:
-        client = openai.OpenAI(api_key=os.environ['OPENAI_API_KEY'])
-    
-    # Helper to escape strings for SQL
-    def escape_sql(value):
-        if value is None:
-            return 'NULL'
-        return "'" + str(value).replace("'", "''") + "'"
+    client = get_openai_client()
     
     try:
         # Use autocommit for Simple Query Protocol
-        conn = psycopg2.connect(dsn)
+        conn = get_db_connection()
         conn.set_session(autocommit=True)
         cur = conn.cursor()
         
-        chunks_created = 0
+        started = time.monotonic()
         safe_event_id = escape_sql(event_id)
         
         if force_refresh:
             cur.execute(f"DELETE FROM t_p17985067_event_email_automati.kb_embeddings WHERE event_id = {safe_event_id}")
         
-        # Векторизация спикеров
-        cur.execute(f"""
-            SELECT speaker_id, name, title, company, topic, bio 
-            FROM t_p17985067_event_email_automati.kb_speakers 
-            WHERE event_id = {safe_event_id}
-        """)
-        speakers = cur.fetchall()
-        
-        for speaker in speakers:
-            speaker_id, name, title, company, topic, bio = speaker
-            text = f"Спикер: {name}. {title or ''} в {company or ''}. Тема доклада: {topic or ''}. Био: {bio or ''}"
-            
-            safe_speaker_id = escape_sql(speaker_id)
-            cur.execute(f"""
-                SELECT COUNT(*) FROM t_p17985067_event_email_automati.kb_embeddings 
-                WHERE event_id = {safe_event_id} AND content_type = 'speaker' AND content_id = {safe_speaker_id}
-            """)
-            
-            if cur.fetchone()[0] == 0:
-                response = client.embeddings.create(
-                    model="text-embedding-ada-002",
-                    input=text
-                )
-                embedding_values = response.data[0].embedding
-                embedding_str = json.dumps(embedding_values)
-                
-                safe_text = escape_sql(text)
-                safe_metadata = escape_sql(json.dumps({'name': name, 'company': company}))
-                safe_embedding = escape_sql(embedding_str)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
-                    (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector)
-                    VALUES ({safe_event_id}, 'speaker', {safe_speaker_id}, {safe_text}, {safe_metadata}, {safe_embedding})
-                """)
-                chunks_created += 1
-        
-        # Векторизация докладов
-        cur.execute(f"""
-            SELECT talk_id, title, description, speaker_id, section_id
-            FROM t_p17985067_event_email_automati.kb_talks 
-            WHERE event_id = {safe_event_id}
-        """)
-        talks = cur.fetchall()
-        
-        for talk in talks:
-            talk_id, title, description, speaker_id, section_id = talk
-            text = f"Доклад: {title or ''}. Описание: {description or ''}"
-            
-            safe_talk_id = escape_sql(talk_id)
-            cur.execute(f"""
-                SELECT COUNT(*) FROM t_p17985067_event_email_automati.kb_embeddings 
-                WHERE event_id = {safe_event_id} AND content_type = 'talk' AND content_id = {safe_talk_id}
-            """)
-            
-            if cur.fetchone()[0] == 0:
-                response = client.embeddings.create(
-                    model="text-embedding-ada-002",
-                    input=text
-                )
-                embedding_values = response.data[0].embedding
-                embedding_str = json.dumps(embedding_values)
-                
-                safe_text = escape_sql(text)
-                safe_metadata = escape_sql(json.dumps({'title': title, 'speaker_id': speaker_id}))
-                safe_embedding = escape_sql(embedding_str)
-                
-                cur.execute(f"""
-                    INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
-                    (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector)
-                    VALUES ({safe_event_id}, 'talk', {safe_talk_id}, {safe_text}, {safe_metadata}, {safe_embedding})
-                """)
-                chunks_created += 1
-        
-        # Векторизация болей аудитории
-        cur.execute(f"""
-            SELECT pain_point FROM t_p17985067_event_email_automati.kb_content 
-            WHERE event_id = {safe_event_id} AND pain_point IS NOT NULL
-        """)
-        pain_points = cur.fetchall()
-        
-        for idx, (pain_point,) in enumerate(pain_points):
-            if pain_point and pain_point.strip():
-                pain_id = escape_sql(f'pain_{idx}')
-                cur.execute(f"""
-                    SELECT COUNT(*) FROM t_p17985067_event_email_automati.kb_embeddings 
-                    WHERE event_id = {safe_event_id} AND content_type = 'pain_point' AND content_id = {pain_id}
-                """)
-                
-                if cur.fetchone()[0] == 0:
-                    response = client.embeddings.create(
-                        model="text-embedding-ada-002",
-                        input=pain_point
-                    )
-                    embedding_values = response.data[0].embedding
-                    embedding_str = json.dumps(embedding_values)
-                    
-                    safe_text = escape_sql(pain_point)
-                    safe_embedding = escape_sql(embedding_str)
-                    
-                    cur.execute(f"""
-                        INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
-                        (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector)
-                        VALUES ({safe_event_id}, 'pain_point', {pain_id}, {safe_text}, '{{}}', {safe_embedding})
-                    """)
-                    chunks_created += 1
-        
-        # Векторизация выгод и ценности
-        cur.execute(f"""
-            SELECT benefit FROM t_p17985067_event_email_automati.kb_content 
-            WHERE event_id = {safe_event_id} AND benefit IS NOT NULL
-        """)
-        benefits = cur.fetchall()
-        
-        for idx, (benefit,) in enumerate(benefits):
-            if benefit and benefit.strip():
-                benefit_id = escape_sql(f'benefit_{idx}')
-                cur.execute(f"""
-                    SELECT COUNT(*) FROM t_p17985067_event_email_automati.kb_embeddings 
-                    WHERE event_id = {safe_event_id} AND content_type = 'benefit' AND content_id = {benefit_id}
-                """)
-                
-                if cur.fetchone()[0] == 0:
-                    response = client.embeddings.create(
-                        model="text-embedding-ada-002",
-                        input=benefit
-                    )
-                    embedding_values = response.data[0].embedding
-                    embedding_str = json.dumps(embedding_values)
-                    
-                    safe_text = escape_sql(benefit)
-                    safe_embedding = escape_sql(embedding_str)
-                    
-                    cur.execute(f"""
-                        INSERT INTO t_p17985067_event_email_automati.kb_embeddings 
-                        (event_id, content_type, content_id, chunk_text, chunk_metadata, embedding_vector)
-                        VALUES ({safe_event_id}, 'benefit', {benefit_id}, {safe_text}, '{{}}', {safe_embedding})
-                    """)
-                    chunks_created += 1
-        
-        conn.close()
+        chunks = collect_chunks(cur, safe_event_id)
+        pending, stale_ids, orphan_ids = diff_chunks(cur, safe_event_id, chunks)
+        embed_stats = embed_chunks(client, cur, pending)
+        write_chunks(cur, safe_event_id, pending, stale_ids + orphan_ids)
+        chunks_created = len(pending) - len(stale_ids)
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'status': 'success',
+                'event_id': event_id,
+                'chunks_total': len(chunks),
                 'chunks_created': chunks_created,
-                'message': f'База знаний проиндексирована. Создано {chunks_created} эмбеддингов.'
+                'chunks_updated': len(stale_ids),
+                'chunks_deleted': len(orphan_ids),
+                'chunks_unchanged': len(chunks) - len(pending),
+                'batches': embed_stats['batches'],
+                'tokens': embed_stats['tokens'],
+                'embedding_cache': {
+                    'memory_hits': embed_stats['memory_hits'],
+                    'db_hits': embed_stats['db_hits'],
+                    'misses': embed_stats['misses']
+                },
+                'elapsed_ms': int((time.monotonic() - started) * 1000),
+                'message': f'База знаний проиндексирована. Создано {chunks_created}, обновлено {len(stale_ids)}, удалено {len(orphan_ids)} эмбеддингов.'
             }),
             'isBase64Encoded': False
         }
@@ -243,3 +447,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
         }
+    finally:
+        if 'conn' in locals():
+            release_db_connection(conn)
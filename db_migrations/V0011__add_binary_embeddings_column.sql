@@ -0,0 +1,14 @@
+-- Compact embedding storage: little-endian float32 bytes (4 bytes per dimension instead of JSON text)
+ALTER TABLE t_p17985067_event_email_automati.kb_embeddings 
+ADD COLUMN IF NOT EXISTS embedding_bin bytea,
+ADD COLUMN IF NOT EXISTS embedding_dim integer,
+ADD COLUMN IF NOT EXISTS embedding_model varchar(100);
+
+-- Float data does not compress, skip TOAST compression attempts
+ALTER TABLE t_p17985067_event_email_automati.kb_embeddings 
+ALTER COLUMN embedding_bin SET STORAGE EXTERNAL;
+
+COMMENT ON COLUMN t_p17985067_event_email_automati.kb_embeddings.embedding_bin IS 'Вектор эмбеддинга: bytea little-endian float32';
+COMMENT ON COLUMN t_p17985067_event_email_automati.kb_embeddings.embedding_dim IS 'Размерность вектора в embedding_bin';
+COMMENT ON COLUMN t_p17985067_event_email_automati.kb_embeddings.embedding_model IS 'Модель, которой построен эмбеддинг';
+COMMENT ON COLUMN t_p17985067_event_email_automati.kb_embeddings.embedding_vector IS 'Устарело: JSONB-вектор, переносится в embedding_bin через rag-vectorize action=backfill_binary';
@@ -0,0 +1,14 @@
+-- Content hash of chunk_text + model for incremental re-vectorization
+ALTER TABLE t_p17985067_event_email_automati.kb_embeddings 
+ADD COLUMN IF NOT EXISTS content_hash varchar(64);
+
+CREATE INDEX IF NOT EXISTS kb_embeddings_event_content_idx 
+ON t_p17985067_event_email_automati.kb_embeddings(event_id, content_type, content_id);
+
+-- Rows written by rag-vectorize before this migration were embedded with text-embedding-ada-002
+UPDATE t_p17985067_event_email_automati.kb_embeddings
+SET embedding_model = COALESCE(embedding_model, 'text-embedding-ada-002'),
+    content_hash = encode(sha256(convert_to(COALESCE(embedding_model, 'text-embedding-ada-002') || E'\n' || chunk_text, 'UTF8')), 'hex')
+WHERE content_hash IS NULL AND content_type IN ('speaker', 'talk', 'pain_point', 'benefit');
+
+COMMENT ON COLUMN t_p17985067_event_email_automati.kb_embeddings.content_hash IS 'SHA256(embedding_model + \n + chunk_text): перевекторизация только изменённых чанков';
@@ -0,0 +1,15 @@
+-- Кэш эмбеддингов: одна и та же строка (био спикера, поисковый запрос) не отправляется в API повторно
+CREATE TABLE IF NOT EXISTS t_p17985067_event_email_automati.embedding_cache (
+    model VARCHAR(100) NOT NULL,
+    text_hash CHAR(64) NOT NULL,
+    embedding_bin BYTEA NOT NULL,
+    embedding_dim INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model, text_hash)
+);
+
+ALTER TABLE t_p17985067_event_email_automati.embedding_cache 
+ALTER COLUMN embedding_bin SET STORAGE EXTERNAL;
+
+COMMENT ON TABLE t_p17985067_event_email_automati.embedding_cache IS 'Кэш эмбеддингов по (модель, SHA256 нормализованного текста)';
+COMMENT ON COLUMN t_p17985067_event_email_automati.embedding_cache.text_hash IS 'SHA256 текста с обрезанными и схлопнутыми пробелами';
@@ -0,0 +1,18 @@
+-- Кеш результатов generate-email: повторная генерация с теми же входами не тратит токены
+CREATE TABLE IF NOT EXISTS generation_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    inputs_hash VARCHAR(32) NOT NULL,
+    template_id INTEGER,
+    event_id INTEGER,
+    recipe_version VARCHAR(20),
+    transform_version VARCHAR(20),
+    output JSONB NOT NULL,
+    hit_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_generation_cache_inputs_hash ON generation_cache(inputs_hash);
+
+COMMENT ON TABLE generation_cache IS 'Детерминированный кеш результатов генерации email';
+COMMENT ON COLUMN generation_cache.cache_key IS 'SHA256 от inputs_hash + хеша шаблона + версий события/знаний + версий рецепта/трансформаций';
@@ -0,0 +1,13 @@
+-- Кеш классификации блоков analyze-template: футеры, отписки и шапки бренда не отправляются в LLM повторно
+CREATE TABLE IF NOT EXISTS block_classification_cache (
+    model VARCHAR(100) NOT NULL,
+    block_hash CHAR(64) NOT NULL,
+    block_type VARCHAR(50) NOT NULL,
+    variable_name VARCHAR(100) NOT NULL,
+    confidence REAL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model, block_hash)
+);
+
+COMMENT ON TABLE block_classification_cache IS 'Кеш классификации блоков по (модель, SHA256 тега и нормализованного текста)';
+COMMENT ON COLUMN block_classification_cache.block_hash IS 'SHA256 от тега и текста блока в нижнем регистре со схлопнутыми пробелами';
@@ -0,0 +1,19 @@
+-- Статус пакетной генерации generate-email: клиент опрашивает его по batch_id, пока пакет выполняется
+CREATE TABLE IF NOT EXISTS generation_batches (
+    batch_id VARCHAR(64) PRIMARY KEY,
+    campaign_id INTEGER,
+    event_id INTEGER,
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    progress JSONB NOT NULL DEFAULT '[]'::jsonb,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_generation_batches_campaign ON generation_batches(campaign_id);
+
+COMMENT ON TABLE generation_batches IS 'Прогресс пакетной генерации писем, обновляется после каждого письма';
+COMMENT ON COLUMN generation_batches.progress IS 'Записи по письмам: index, campaign_email_id, status, cache, elapsed_ms';
@@ -0,0 +1,17 @@
+-- Частичный результат одиночной генерации generate-email и rag-content-gen: клиент опрашивает его по progress_id, пока POST выполняется
+CREATE TABLE IF NOT EXISTS generation_progress (
+    progress_id VARCHAR(64) PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    partial_text TEXT NOT NULL DEFAULT '',
+    fields JSONB NOT NULL DEFAULT '{}'::jsonb,
+    result JSONB,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE generation_progress IS 'Потоковый ответ модели, сохраняемый по мере поступления: HTTP-ответ функции буферизуется целиком, поэтому частичный вывод отдаётся через опрос';
+COMMENT ON COLUMN generation_progress.partial_text IS 'Текст ответа модели, полученный к моменту последней записи';
+COMMENT ON COLUMN generation_progress.fields IS 'Поля письма, уже полностью полученные от модели (subject, preheader, недостающие переменные)';
+COMMENT ON COLUMN generation_progress.result IS 'Финальное событие: валидация (generate-email) или готовый текст с проверкой длины (rag-content-gen)';
@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import Icon from '@/components/ui/icon';
+import { fetchAllPages } from '@/lib/api';
 
 interface Event {
   event_id: string;
@@ -31,11 +32,8 @@ export default function EmailGenerator() {
 
   const loadEvents = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
-      if (response.ok) {
-        const data = await response.json();
-        setEvents(data);
-      }
+      const data = await fetchAllPages('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
+      setEvents(data);
     } catch (error) {
       console.error('Failed to load events:', error);
     }
@@ -43,11 +41,8 @@ export default function EmailGenerator() {
 
   const loadTemplates = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12');
-      if (response.ok) {
-        const data = await response.json();
-        setTemplates(data);
-      }
+      const data = await fetchAllPages('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12');
+      setTemplates(data);
     } catch (error) {
       console.error('Failed to load templates:', error);
     }
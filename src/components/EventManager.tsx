@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import Icon from '@/components/ui/icon';
+import { fetchAllPages } from '@/lib/api';
 import KnowledgeBaseManager from './KnowledgeBaseManager';
 
 interface Event {
@@ -27,11 +28,8 @@ export default function EventManager() {
 
   const loadEvents = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
-      if (response.ok) {
-        const data = await response.json();
-        setEvents(data);
-      }
+      const data = await fetchAllPages('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
+      setEvents(data);
     } catch (error) {
       console.error('Failed to load events:', error);
     }
@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { Plus, Calendar, Edit, Trash2, Sparkles, X } from 'lucide-react';
+import { fetchAllPages } from '@/lib/api';
 
 interface Event {
   id: number;
@@ -28,8 +29,7 @@ export default function EventsManager() {
   const loadEvents = async () => {
     setLoading(true);
     try {
-      const response = await fetch('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
-      const data = await response.json();
+      const data = await fetchAllPages('https://functions.poehali.dev/5d528b9a-f814-4e0a-9250-d3a7bc40acb6');
       setEvents(data);
     } catch (error) {
       console.error('Failed to load events:', error);
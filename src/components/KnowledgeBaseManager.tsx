@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import Icon from '@/components/ui/icon';
+import { fetchAllPages } from '@/lib/api';
 
 interface Event {
   id?: number;
@@ -34,11 +35,8 @@ export default function KnowledgeBaseManager({ event, onClose }: KnowledgeBaseMa
 
   const loadTemplates = async () => {
     try {
-      const response = await fetch('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12');
-      if (response.ok) {
-        const data = await response.json();
-        setTemplates(data);
-      }
+      const data = await fetchAllPages('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12');
+      setTemplates(data);
     } catch (error) {
       console.error('Failed to load templates:', error);
     }
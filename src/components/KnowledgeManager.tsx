@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { Plus, BookOpen, FileText, Brain, Lightbulb, Users, X } from 'lucide-react';
+import { fetchAllPages } from '@/lib/api';
 
 interface Knowledge {
   id: number;
@@ -25,8 +26,7 @@ export default function KnowledgeManager() {
   const loadKnowledge = async () => {
     setLoading(true);
     try {
-      const response = await fetch('https://functions.poehali.dev/1793bb22-ead4-461c-a1dc-99d12754688c');
-      const data = await response.json();
+      const data = await fetchAllPages('https://functions.poehali.dev/1793bb22-ead4-461c-a1dc-99d12754688c', { fields: 'id,content_type,title,content' });
       const mappedData = data.map((item: any) => ({
         id: item.id,
         category: item.content_type,
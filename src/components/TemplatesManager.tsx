@@ -1,5 +1,6 @@
 import { useState, useRef, useEffect } from 'react';
 import { Plus, FileText, Upload, Sparkles, CheckCircle, X } from 'lucide-react';
+import { fetchAllPages } from '@/lib/api';
 
 interface Template {
   id: number;
@@ -48,8 +49,7 @@ export default function TemplatesManager() {
   const loadTemplates = async () => {
     setLoading(true);
     try {
-      const response = await fetch('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12');
-      const data = await response.json();
+      const data = await fetchAllPages('https://functions.poehali.dev/68c6506f-0606-43d5-8c75-f4b1fd9e1c12', { fields: 'id,name,created_at' });
       const mappedData = data.map((item: any) => ({
         id: item.id,
         name: item.name,
@@ -0,0 +1,24 @@
+interface Page<T> {
+  items: T[];
+  next_cursor: string | null;
+  total?: number;
+}
+
+export async function fetchAllPages<T = any>(url: string, params: Record<string, string> = {}): Promise<T[]> {
+  const items: T[] = [];
+  let cursor: string | null = null;
+
+  do {
+    const query = new URLSearchParams({ limit: '200', ...params });
+    if (cursor) query.set('cursor', cursor);
+    const response = await fetch(`${url}?${query.toString()}`);
+    if (!response.ok) {
+      throw new Error(`Request failed with status ${response.status}`);
+    }
+    const page: Page<T> = await response.json();
+    items.push(...page.items);
+    cursor = page.next_cursor;
+  } while (cursor);
+
+  return items;
+}